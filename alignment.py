@@ -0,0 +1,119 @@
+"""
+Versification alignment of two bible versions, eg KJV and CUV.
+
+Both versions number verses alike, except where one of them lacks a verse,
+eg John 7:53 in CUV, or 3 John 1:15 in KJV.  An Alignment holds, for each
+chapter, either its no. of verses, when both versions have the same verses,
+or else the pairs of verse numbers, None for the verse a version lacks:
+
+    John 7      [[1, 1], [2, 2], ... [52, 52], [53, None]]
+
+It is saved as json alongside the text files, stamped with their size and
+mtime, so it is built once, and again only when a text file is replaced.
+To build it along with the corpus files:
+    python alignment.py bible.pbc cbible.pbc alignment.json
+"""
+
+import json, os, sys
+
+
+class Alignment:
+    """ (book, chapter) -> verse pairs of two versions
+    """
+    def __init__(self, languages, chapters, sources=None):
+        self.languages = tuple(languages)   # the two versions, eg ('en', 'zh-TW')
+        self.chapters = chapters            # (book, chapter) -> no. of verses, or [[verse, verse]*]
+        self.sources = sources or {}        # text file -> [size, mtime], as built from
+
+    @classmethod
+    def build(cls, first, second, languages=('en', 'zh-TW'), sources=None):
+        """ align verses of two versions (nested dict or VerseStore), by verse number
+        """
+        chapters = {}
+        for book in first:
+            for chapter in first[book]:
+                verses = list(first[book][chapter].keys())
+                others = list(second[book][chapter].keys()) if book in second and chapter in second[book] else []
+                if verses == others:
+                    chapters[(book, chapter)] = len(verses)
+                else:
+                    verses, others = set(verses), set(others)
+                    chapters[(book, chapter)] = [[v if v in verses else None, v if v in others else None]
+                                                 for v in sorted(verses | others)]
+        return cls(languages, chapters, sources)
+
+    def pairs(self, book, chapter):
+        """ [(verse, verse)*] of chapter, None for a verse missing in a version
+        """
+        aligned = self.chapters[(book, chapter)]
+        if isinstance(aligned, int):
+            return [(verse, verse) for verse in range(1, aligned + 1)]
+        return [tuple(pair) for pair in aligned]
+
+    def mismatches(self, book=None):
+        """ [(book, chapter, no. of verses, no. of verses)*] of chapters not
+                verse by verse the same, in book if given
+        """
+        result = []
+        for (b, chapter), aligned in self.chapters.items():
+            if isinstance(aligned, list) and (book is None or b == book):
+                result.append((b, chapter, sum(1 for v, _ in aligned if v is not None),
+                               sum(1 for _, v in aligned if v is not None)))
+        return result
+
+    def save(self, fileName):
+        """ write aside and rename, so it is never half written
+        """
+        books = {}
+        for (book, chapter), aligned in self.chapters.items():
+            books.setdefault(book, {})[str(chapter)] = aligned
+        tmpName = f"{fileName}.tmp"
+        with open(tmpName, 'w', encoding='utf-8') as f:
+            json.dump({'languages': self.languages, 'sources': self.sources, 'chapters': books},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmpName, fileName)
+
+    @classmethod
+    def load(cls, fileName):
+        with open(fileName, encoding='utf-8') as f:
+            data = json.load(f)
+        chapters = {(book, int(chapter)): aligned
+                    for book, byChapter in data['chapters'].items() for chapter, aligned in byChapter.items()}
+        return cls(data['languages'], chapters, data['sources'])
+
+
+def stamp(fileNames):
+    """ {file: [size, mtime]} of text files, which an alignment is built from
+    """
+    result = {}
+    for fileName in fileNames:
+        stat = os.stat(fileName)
+        result[fileName] = [stat.st_size, stat.st_mtime_ns]
+    return result
+
+def load_alignment(fileName, first, second):
+    """ Alignment saved in fileName, or None if there is none, or it was not
+            built from the text files first and second, as they are now
+    """
+    try:
+        alignment = Alignment.load(fileName)
+    except (OSError, ValueError, KeyError):
+        return None
+    try:
+        if alignment.sources != stamp([first, second]):
+            return None
+    except OSError:
+        return None
+    return alignment
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(f"usage: python {sys.argv[0]} bible.pbc cbible.pbc alignment.json")
+        sys.exit(1)
+    from versestore import load_corpus
+    first, second, fileName = sys.argv[1:]
+    alignment = Alignment.build(load_corpus(first), load_corpus(second), sources=stamp([first, second]))
+    alignment.save(fileName)
+    for book, chapter, count, other in alignment.mismatches():
+        print(f"    {book}:{chapter} Diff {count} <--> {other}")
@@ -0,0 +1,277 @@
+"""
+Content-addressed cache of audio files.
+
+Each audio file is keyed by a hash of what it was made from, ie
+(text, language, voice, engine), and recorded in a manifest, ie
+./audio/manifest.json, along with its size, mtime and duration:
+
+    1. a file is only reused if its key is the one of the text to speak,
+       so corrected verses, or another voice, are synthesized again,
+    2. a file is only reused if it is still what was recorded, so a
+       truncated mp3 from a crashed run is synthesized again,
+    3. verse audio lives in ./audio/tmp/{language}/{key}.mp3, and is
+       evicted, least recently used first, when over a byte budget, but not
+       the segments of chapters being built, see pinned().  The segments
+       chapter audio is made of (as recorded with it) are evicted as any
+       other verse audio, and synthesized again if a verse of the chapter
+       is corrected, unless keep_segments: then a correction costs one
+       segment, but tmp holds a copy of all chapter audio built, outside
+       the budget, ie about twice the disk space.
+
+mp3_frames() walks the frames of mp3 data, which gives both the
+integrity check and the duration; concat_mp3() joins mp3 files frame by
+frame, without decoding, eg verse audio into chapter audio.
+"""
+
+import hashlib, json, os, threading, time
+from collections import Counter
+from contextlib import contextmanager
+
+#   bit rates (kbit/s) by [version is MPEG-1][layer], sample rates by version
+_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLERATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def id3_size(data):
+    """ size of ID3v2 tag at the start of data, 0 if there is none
+    """
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def frame_header(data, pos):
+    """ (length, samples, sample rate) of the mp3 frame at data[pos], or None
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos+1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos+1] >> 3) & 3            # 3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5
+    layer = 4 - ((data[pos+1] >> 1) & 3)        # 1, 2 or 3
+    bitrateIndex = data[pos+2] >> 4
+    rateIndex = (data[pos+2] >> 2) & 3
+    padding = (data[pos+2] >> 1) & 1
+    if version == 1 or layer == 4 or bitrateIndex in (0, 15) or rateIndex == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrateIndex] * 1000
+    rate = _SAMPLERATES[version][rateIndex]
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, 384, rate
+    if layer == 2 or mpeg1:
+        return 144 * bitrate // rate + padding, 1152, rate
+    return 72 * bitrate // rate + padding, 576, rate
+
+def mp3_frames(data):
+    """ frames of mp3 data, as [(offset, length, samples, sample rate)*]
+
+    raise ValueError if data is not whole mp3 frames, eg it is truncated
+    """
+    pos = id3_size(data)
+    end = len(data)
+    if end - pos >= 128 and data[end-128:end-125] == b'TAG':    # ID3v1 at the end
+        end -= 128
+    frames = []
+    while pos < end:
+        header = frame_header(data, pos)
+        if header is None or pos + header[0] > end:
+            raise ValueError(f"Broken mp3 frame at byte {pos}.")
+        frames.append((pos, header[0], header[1], header[2]))
+        pos += header[0]
+    if not frames:
+        raise ValueError("No mp3 frames.")
+    return frames
+
+def mp3_payload(data):
+    """ audio frames of mp3 data as one slice, without ID3 tags and the
+            Xing/Info/VBRI header frame (which describes the file, not audio)
+    """
+    frames = mp3_frames(data)
+    offset, length = frames[0][:2]
+    if len(frames) > 1 and any(tag in data[offset:offset+length] for tag in (b'Xing', b'Info', b'VBRI')):
+        frames = frames[1:]
+    return data[frames[0][0]:frames[-1][0] + frames[-1][1]]
+
+def concat_mp3(fileNames, outName):
+    """ concatenate mp3 files into outName, frame by frame
+
+    raise ValueError if any of them is not whole mp3 frames
+    """
+    payloads = []
+    for fileName in fileNames:
+        with open(fileName, 'rb') as f:
+            payloads.append(mp3_payload(f.read()))
+    tmpName = f"{outName}.part"
+    with open(tmpName, 'wb') as f:
+        for payload in payloads:
+            f.write(payload)
+    os.replace(tmpName, outName)
+
+def mp3_duration(data):
+    """ duration (seconds) of mp3 data
+    """
+    return sum(samples / rate for _, _, samples, rate in mp3_frames(data))
+
+
+class AudioCache:
+    """ manifest of audio files, keyed by (text, language, voice, engine)
+    """
+    def __init__(self, root='./audio', budget=0, keep_segments=False):
+        self.root = root
+        self.budget = budget            # bytes of verse audio kept in tmp, 0 for no limit
+        self.keepSegments = keep_segments   # segments of chapter audio are not evicted, nor
+                                            #   counted in budget
+        self.manifestFile = os.path.join(root, 'manifest.json')
+        #   left by the first manifest written, so files made before there was
+        #       one are adopted once, not after a manifest is lost or corrupt
+        self.migratedFile = os.path.join(root, 'migrated')
+        self._entries = None
+        self._adopt = False             # adopt files not in manifest, see lookup()
+        self._pins = Counter()          # file -> no. of jobs using it, not to be evicted
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(text, language, voice, engine):
+        """ hash of what the audio is made from
+        """
+        return hashlib.sha256('\0'.join((engine, voice, language, text)).encode('utf-8')).hexdigest()
+
+    def verse_path(self, key, language):
+        """ content-addressed file name of verse audio
+        """
+        directory = os.path.join(self.root, 'tmp', language)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{key}.mp3")
+
+    def entries(self):
+        with self._lock:
+            if self._entries is None:
+                try:
+                    with open(self.manifestFile, encoding='utf-8') as f:
+                        self._entries = json.load(f)
+                except FileNotFoundError:
+                    self._entries = {}
+                    self._adopt = not os.path.exists(self.migratedFile)
+                except (OSError, ValueError):
+                    self._entries = {}
+            return self._entries
+
+    def save(self):
+        """ write manifest aside and rename it, so it is never half written
+        """
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            tmpName = f"{self.manifestFile}.tmp"
+            with open(tmpName, 'w', encoding='utf-8') as f:
+                json.dump(self.entries(), f, indent=1, sort_keys=True)
+            os.replace(tmpName, self.manifestFile)
+            if not os.path.exists(self.migratedFile):
+                open(self.migratedFile, 'w').close()
+
+    def lookup(self, fileName, key):
+        """ True if fileName is the audio of key, and intact
+
+        an mp3 made before there was a manifest is checked frame by frame,
+            and adopted if it is whole, but only in a run that found no
+            manifest ever written; any other file not in manifest is made
+            again, as it may be of another key
+        """
+        path = os.path.normpath(fileName)
+        with self._lock:
+            entry = self.entries().get(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if entry:
+                    self.entries().pop(path)
+                return False
+            if entry is None:
+                if not self._adopt:
+                    return False
+                try:
+                    self.record(path, key)
+                except ValueError:
+                    return False
+                return True
+            if entry['key'] != key or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                self.entries().pop(path)
+                return False
+            entry['atime'] = time.time()
+            return True
+
+    def record(self, fileName, key, parts=None):
+        """ add a (newly synthesized) file to manifest, along with the segment
+                files it is joined from, if any, which are then not evicted
+
+        raise ValueError if it is not a whole mp3 file
+        """
+        path = os.path.normpath(fileName)
+        with open(path, 'rb') as f:
+            data = f.read()
+        duration = mp3_duration(data)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self.entries()[path] = {
+                'key': key, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'duration': round(duration, 3), 'atime': time.time(),
+            }
+            if parts:
+                entry['parts'] = [os.path.normpath(part) for part in parts]
+
+    def link(self, fileName, parts):
+        """ record the segment files fileName is joined from, if it is in
+                manifest without them, eg it was recorded by an older version
+        """
+        with self._lock:
+            entry = self.entries().get(os.path.normpath(fileName))
+            if entry is not None and 'parts' not in entry:
+                entry['parts'] = [os.path.normpath(part) for part in parts]
+
+    @contextmanager
+    def pinned(self, fileNames):
+        """ with pinned(fileNames): ...
+                files are not evicted, eg segments of chapter audio being
+                assembled, even by evict() of another thread
+        """
+        paths = Counter(os.path.normpath(fileName) for fileName in fileNames)
+        with self._lock:
+            self._pins.update(paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins -= paths
+
+    def evict(self):
+        """ remove least recently used verse audio until it is within budget,
+                but not pinned files, nor segments of chapter audio if keepSegments
+        """
+        if not self.budget:
+            return []
+        tmpRoot = os.path.join(os.path.normpath(self.root), 'tmp') + os.sep
+        removed = []
+        with self._lock:
+            entries = self.entries()
+            kept = set(self._pins)
+            if self.keepSegments:
+                kept.update(part for e in entries.values() for part in e.get('parts', ()))
+            verses = sorted((e['atime'], path) for path, e in entries.items()
+                            if path.startswith(tmpRoot) and path not in kept)
+            total = sum(entries[path]['size'] for _, path in verses)
+            for _, path in verses:
+                if total <= self.budget:
+                    break
+                total -= entries.pop(path)['size']
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                removed.append(path)
+        return removed
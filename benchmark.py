@@ -0,0 +1,191 @@
+"""
+Benchmark of PyBible, offline, as json, eg to compare one release with another:
+
+    python benchmark.py -o bench.json
+    python benchmark.py --repeat 20 --no-index
+
+times
+    load            loading each text file, as in [TEXT] of config.ini: by
+                    pickle.load if it is a pickle file, and by load_corpus
+                    of its binary corpus file, after a first load converts it
+    search_key      keyword search of a chapter, by query
+    search_ALL      keyword search of all books, by query
+    index_bible     building the whoosh index of each language
+    isearch         indexed search, p50/p99 over all queries
+    display_book    printing a book, both languages, to a null sink
+    audio           chapter audio of a book, by a stub TTS engine: all
+                    synthesized, and then all cached
+
+Search results are not cached while they are timed, see bible.searchCache.
+Index and audio files are made in a temporary directory, and removed.
+"""
+
+import argparse, json, os, pickle, platform, statistics, tempfile, time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import bible
+import tts
+from audiocache import AudioCache
+from versestore import corpus_name, load_corpus
+
+QUERIES = {
+    'en': ['God', 'what wilt thou', 'everlasting life', 'lov(e|eth)', r'\blight\b'],
+    'zh-TW': ['神', '耶穌基督', '愛人如己', '義人必因信得生', '神的旨意', '(耶穌|基督)'],
+}
+#   indexed search takes words, not regular expressions, and a Chinese query
+#       is one word as jieba splits it, eg 耶穌 and 基督, not 耶穌基督
+INDEX_QUERIES = {
+    'en': ['god', 'everlasting life', 'light', 'what wilt thou'],
+    'zh-TW': ['耶穌', '基督', '世人', '旨意'],
+}
+
+
+class StubTTS(tts.FakeTTS):
+    """ FakeTTS taking delay seconds a call, as if it were over the network
+    """
+    delay_s = 0.0
+
+    def __init__(self, language='zh-TW'):
+        super().__init__(language, delay=self.delay_s)
+
+
+def timed(function, *args):
+    """ (seconds, result) of function(*args)
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def stats(samples):
+    """ summary of samples (seconds), in ms
+    """
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1e3
+    return {'n': len(ordered), 'min_ms': ordered[0] * 1e3, 'p50_ms': percentile(0.5),
+            'p99_ms': percentile(0.99), 'max_ms': ordered[-1] * 1e3, 'mean_ms': statistics.fmean(ordered) * 1e3}
+
+def load_pickle(fileName):
+    with open(fileName, 'rb') as f:
+        return pickle.load(f, encoding='utf-8')
+
+def bench_load(repeat):
+    report = {}
+    for language, fileName in (('en', bible.englishText), ('zh-TW', bible.chineseText)):
+        load_corpus(fileName)           # converts a pickle file, if not yet
+        rows = []
+        binaryName = corpus_name(fileName)
+        if binaryName != fileName and os.path.exists(binaryName):
+            rows.append(('pickle.load', load_pickle, fileName))
+            fileName = binaryName
+        rows.append(('load_corpus', load_corpus, fileName))
+        report[language] = {how: {'file': os.path.basename(name), 'bytes': os.path.getsize(name),
+                                  **stats([timed(function, name)[0] for _ in range(repeat)])}
+                            for how, function, name in rows}
+    return report
+
+def bench_search(repeat):
+    keyReport, allReport, warmup = {}, {}, {}
+    for language, queries in QUERIES.items():
+        #   first use builds the search engine, and its packed text
+        warmup[language] = timed(bible.search_ALL, queries[0], language)[0] * 1e3
+        keyReport[language] = {kw: stats([timed(bible.search_key, 'John', 3, kw, language)[0] for _ in range(repeat)])
+                               for kw in queries}
+        allReport[language] = {}
+        for kw in queries:
+            samples = []
+            for _ in range(repeat):
+                seconds, result = timed(bible.search_ALL, kw, language)
+                samples.append(seconds)
+            allReport[language][kw] = dict(stats(samples), verses=sum(len(v) for _, _, v in result))
+    return keyReport, allReport, warmup
+
+def bench_index(repeat):
+    buildReport, queryReport = {}, {}
+    try:
+        import whoosh
+    except ImportError:
+        return {'skipped': 'whoosh is not installed'}, {'skipped': 'whoosh is not installed'}
+    for language, queries in INDEX_QUERIES.items():
+        bible.language = language
+        with open(os.devnull, 'w') as sink, redirect_stdout(sink):
+            seconds, _ = timed(bible.index_bible)
+        if not os.path.exists(f"indexdir_{language}"):
+            buildReport[language] = queryReport[language] = {'skipped': 'jieba is not installed'}
+            continue
+        buildReport[language] = {'s': seconds}
+        hits = {q: len(bible.isearch('allbooks', q, language)) for q in queries}      # opens the index, too
+        samples = [timed(bible.isearch, 'allbooks', q, language)[0] for _ in range(repeat) for q in queries]
+        queryReport[language] = dict(stats(samples), hits=hits)
+    return buildReport, queryReport
+
+def bench_display(book, repeat):
+    with open(os.devnull, 'w') as sink, redirect_stdout(sink):
+        samples = [timed(bible.display_book, book)[0] for _ in range(repeat)]
+    return dict(stats(samples), book=book)
+
+def bench_audio(book, language, delay):
+    StubTTS.delay_s = delay
+    tts.ENGINES['fake'] = StubTTS
+    chapters = list(range(1, bible.bookIndex(language).chapsInBook[book] + 1))
+    report = {'book': book, 'language': language, 'delay_s': delay, 'max_concurrency': bible.maxConcurrency}
+    with open(os.devnull, 'w') as sink, redirect_stdout(sink):
+        for run in ('synthesized', 'cached'):
+            seconds, summary = timed(bible.audio_chapters, book, chapters, language, 'fake')
+            segments = summary.segments
+            report[run] = {'s': seconds, 'generated': len(summary.generated), 'cached': len(summary.cached),
+                           'failed': len(summary.failed), 'segments_generated': len(segments.generated),
+                           'segments_cached': len(segments.cached)}
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-o', '--output', help='json file, stdout if not given')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='runs of each timing')
+    parser.add_argument('--no-index', action='store_true', help='skip index_bible and isearch')
+    parser.add_argument('--book', default='Psalms', help='book of display_book')
+    parser.add_argument('--audio-book', default='Ruth', help='book of audio, in zh-TW')
+    parser.add_argument('--tts-delay', type=float, default=0.05, help='seconds of a stub TTS call')
+    args = parser.parse_args(argv)
+
+    #   index and audio files go to a temporary directory, config and text files stay where they are
+    bible._cfg = bible.Config(os.path.abspath(bible._configfile))
+    bible.englishText = os.path.abspath(bible.englishText)
+    bible.chineseText = os.path.abspath(bible.chineseText)
+    bible.alignmentFile = os.path.abspath(bible.alignmentFile)
+    bible.journal.fileName = os.path.abspath(bible.journal.fileName)
+    bible.searchCache.maxEntries = 0
+    bible.searchCache.clear()
+
+    report = {'time': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(), 'repeat': args.repeat}
+    try:
+        import numpy
+        report['numpy'] = numpy.__version__
+    except ImportError:
+        report['numpy'] = None
+    report['load'] = bench_load(args.repeat)
+    report['search_key'], report['search_ALL'], report['search_warmup_ms'] = bench_search(args.repeat)
+    report['display_book'] = bench_display(args.book, max(1, args.repeat // 5))
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='pybible-bench-') as tmp:
+        os.chdir(tmp)
+        try:
+            if not args.no_index:
+                report['index_bible'], report['isearch'] = bench_index(args.repeat)
+                bible.indexManager.close()
+            bible.audioCache = AudioCache(os.path.join(tmp, 'audio'))
+            report['audio'] = bench_audio(args.audio_book, 'zh-TW', args.tts_delay)
+        finally:
+            os.chdir(cwd)
+
+    text = json.dumps(report, ensure_ascii=False, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -18,17 +18,26 @@ July 5, 2021
 
 """
 
+from collections import namedtuple
 from configparser import ConfigParser
-import os, platform, sys
-import pickle
+from contextlib import contextmanager, redirect_stdout
+import argparse, json
+import os, platform, sys, threading, time
 import random, re
 from pathlib import Path
 
-from whoosh.fields import Schema, TEXT, KEYWORD, STORED
-from whoosh.filedb.filestore import FileStorage
-from whoosh.qparser import QueryParser, MultifieldParser
-from whoosh.query import *
+from alignment import Alignment, load_alignment, stamp
+from audiocache import AudioCache
+import references
+from resultcache import LRUCache
+from searchengine import SearchEngine
+import tracing
+from versestore import Journal, load_corpus
 
+#
+#   whoosh (and jieba) are imported only when indexing or indexed search is used,
+#       and server (asyncio) only when serving, see serve()
+#
 
 try:
     import icecream
@@ -37,54 +46,156 @@ except ImportError:
     ic = print
 
 class Config:
+    """ config.ini, parsed once and reparsed only when the file changes
+    """
     def __init__(self, configfile, verbose=False):
         self.configfile = configfile
         self.verbose = verbose
+        self._config = None         # parsed ConfigParser
+        self._mtime = None          # mtime of configfile when parsed
 
-    def set_config(self, section, key, value):
+    def _load(self):
         config_file_path = self.configfile
-        config = ConfigParser()
         try:
-            with open(config_file_path) as conf:
-                config.read(config_file_path)
-                config[section][key] = value
-                with open(config_file_path, 'w') as conf:
-                    config.write(conf)
+            mtime = os.stat(config_file_path).st_mtime_ns
+            if self._config is None or mtime != self._mtime:
+                config = ConfigParser()
+                with open(config_file_path) as conf:
+                    config.read_file(conf)
+                self._config, self._mtime = config, mtime
         except (OSError, IOError) as e:
             raise Exception("Couldn't find path to config.ini.") from e
-        if self.verbose:
-            print(f"  SET config[{section}, {key}] = {value}", file=sys.stderr)
+        return self._config
 
-    def get_config(self, section, key):
+    def update(self, changes):
+        """ set many values, ie {section: {key: value}}, with a single write
+
+        the file is written aside and then renamed, so it is never half written
+        """
         config_file_path = self.configfile
-        config = ConfigParser()
+        config = self._load()
+        for section, items in changes.items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in items.items():
+                config[section][key] = value
+        tmp_file_path = f"{config_file_path}.tmp"
         try:
-            with open(config_file_path) as conf:
-                config.read(config_file_path)
-                value = config.get(section, key)
-                if self.verbose:
-                    print(f"  GET config[{section}, {key}] = {value}", file=sys.stderr)
-                return value
+            with open(tmp_file_path, 'w') as conf:
+                config.write(conf)
+            os.replace(tmp_file_path, config_file_path)
+            self._mtime = os.stat(config_file_path).st_mtime_ns
         except (OSError, IOError) as e:
+            self._config = None     # reparse what is on disk next time
             raise Exception("Couldn't find path to config.ini.") from e
+        if self.verbose:
+            for section, items in changes.items():
+                for key, value in items.items():
+                    print(f"  SET config[{section}, {key}] = {value}", file=sys.stderr)
+
+    def set_config(self, section, key, value):
+        self.update({section: {key: value}})
+
+    def get_config(self, section, key, fallback=None):
+        """ value of config[section, key], or fallback (if given) when there is no such key
+        """
+        config = self._load()
+        if fallback is not None and not config.has_option(section, key):
+            value = fallback
+        else:
+            value = config.get(section, key)
+        if self.verbose:
+            print(f"  GET config[{section}, {key}] = {value}", file=sys.stderr)
+        return value
 
     def list_config(self):
-        config_file_path = self.configfile
-        config = ConfigParser()
+        config = self._load()
         print(f"\n--- Configuration ---")
         print(f"Contents of config file: {self.configfile}")
+        for section in config.sections():
+            print(f"    {section}")
+            for key in config[section]:
+                _value = config.get(section, key)
+                value = _value if _value else '-NULL-'
+                print(f"        {key} :   {value}")
+            print()
+
+class IndexManager:
+    """ whoosh index of each language, ie indexdir_{language}, opened once
+
+    a searcher is kept for each language and refreshed only when the
+        index changes, see version(), eg after index_bible(), also of
+        another process
+    """
+    def __init__(self):
+        self._indexes = {}          # language -> opened index
+        self._versions = {}         # language -> version() of the index when opened
+        self._searchers = {}        # language -> searcher on the index
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def version(language):
+        """ (generation, mtime, size) of the latest TOC of indexdir_{language},
+                None if there is none; it changes on every commit, and on every
+                index_bible(), though generations are numbered from 1 again
+        """
+        directory = f"indexdir_{language}"
         try:
-            with open(config_file_path) as conf:
-                config.read(config_file_path)
-                for section in config.sections():
-                    print(f"    {section}")
-                    for key in config[section]:
-                        _value = config.get(section, key)
-                        value = _value if _value else '-NULL-'
-                        print(f"        {key} :   {value}")
-                    print()
-        except (OSError, IOError) as e:
-            raise Exception("Couldn't find path to config.ini.") from e
+            tocs = [(int(m.group(1)), name) for name in os.listdir(directory)
+                    for m in [re.fullmatch(r"_MAIN_(\d+)\.toc", name)] if m]
+            generation, name = max(tocs, default=(None, None))
+            if name is None:
+                return None
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:             # not indexed, or being rebuilt
+            return None
+        return generation, stat.st_mtime_ns, stat.st_size
+
+    def index(self, language):
+        """ the index of language, opened again if it changed since it was opened
+        """
+        with self._lock:
+            version = self.version(language)
+            if language in self._indexes and version != self._versions.get(language):
+                s = self._searchers.pop(language, None)
+                s and s.close()
+                self._indexes.pop(language)
+            if language not in self._indexes:
+                from whoosh.filedb.filestore import FileStorage
+                self._indexes[language] = FileStorage(f"indexdir_{language}").open_index()
+                self._versions[language] = version
+            return self._indexes[language]
+
+    def searcher(self, language):
+        """ the cached searcher of language, up to date with the index
+        """
+        with self._lock:
+            ix = self.index(language)
+            s = self._searchers.get(language)
+            if s is None:
+                s = ix.searcher()
+            elif not s.up_to_date():
+                s = s.refresh()
+            self._searchers[language] = s
+            return s
+
+    @contextmanager
+    def using(self, language):
+        """ with using(language) as s: ...
+                searcher is not closed at the end, and only one thread uses it at a time
+        """
+        with self._lock:
+            yield self.searcher(language)
+
+    def close(self, language=None):
+        """ close cached searcher and index of language, or of all languages
+        """
+        with self._lock:
+            for lang in ([language] if language else list(self._indexes)):
+                s = self._searchers.pop(lang, None)
+                s and s.close()
+                self._indexes.pop(lang, None)
+                self._versions.pop(lang, None)
 
 def index_bible():
     """
@@ -92,9 +203,13 @@ def index_bible():
         ChineseAnalyzer from jieba is used as analyzer
         default for english
     """
+    from whoosh.fields import Schema, TEXT, ID
+    from whoosh.filedb.filestore import FileStorage
 
+    OTbooks, NTbooks, ALLbooks, chapsInBook = bookIndex(language)
     #
     #   define schema
+    #       id is unique, so one verse can be updated, see reindex_verse()
     #
     if language == 'zh-TW':
         missing_jieba = False
@@ -108,13 +223,13 @@ def index_bible():
             return None
         analyzer = ChineseAnalyzer()
         schema = Schema(
-            id=STORED,
+            id=ID(unique=True, stored=True),
             content=TEXT(phrase=True, stored=True, analyzer=analyzer),
             tags=TEXT(stored=True)
         )
     else:
         schema = Schema(
-            id=STORED,
+            id=ID(unique=True, stored=True),
             content=TEXT(phrase=True, stored=True),
             tags=TEXT(stored=True)
         )
@@ -123,22 +238,26 @@ def index_bible():
     if not os.path.exists(f"indexdir_{language}"):
         os.mkdir(f"indexdir_{language}")        
     storage = FileStorage(f"indexdir_{language}")
+    #   searcher on the old index is useless now
+    indexManager.close(language)
     # Create an index
     ix = storage.create_index(schema)
 
     #
     #   real indexing
+    #       documents are handed to a pool of processes, each tokenizes and
+    #       writes its own segment, and the segments are merged at commit
     #
-    writer = ix.writer()
+    procs = int(_cfg.get_config('INDEX', 'procs', '0')) or os.cpu_count()
+    limitmb = int(_cfg.get_config('INDEX', 'limitmb', '128'))
+    writer = ix.writer(procs=procs, limitmb=limitmb)
 
     bibletoUse = selectBible(language)
+    start = time.perf_counter()
+    count = 0
     #       loop over all books
-    for book in ALLbooks:
-        if book in OTbooks:
-            mytag = f"{book.replace(' ', '')}, OldTestament, AllBooks"
-        else:
-            mytag = f"{book.replace(' ', '')}, NewTestament, AllBooks"
-        print(f"\nindexing {mytag} ...")
+    for n, book in enumerate(ALLbooks, 1):
+        mytag = indexTags(book, OTbooks)
         for chapter in range(1, chapsInBook[book]+1):
             for verse in range(1, len(bibletoUse[book][chapter])+1):
                 writer.add_document(
@@ -146,91 +265,190 @@ def index_bible():
                     content = bibletoUse[book][chapter][verse],
                     tags = mytag 
                 )
+                count += 1
+        print(f"\r  indexing {n}/{len(ALLbooks)} books, {count} verses ...", end='', flush=True)
+    added = time.perf_counter()
+    print(f"\n  merging segments ...")
     writer.commit()    
+    done = time.perf_counter()
+    #   indexed search results of the old index are out of date
+    searchCache.discard(lambda key: key[0] == language and key[3] == 'indexed')
+    #   verses corrected while indexing may have been read before they were
+    reindex_stale(language)
+    #
+    #   report
+    #
+    print(f"\n--- Index of {language} in indexdir_{language} ---")
+    print(f"    verses :     {count}")
+    print(f"    processes :  {procs}")
+    print(f"    adding :     {added - start:.1f} s")
+    print(f"    merging :    {done - added:.1f} s")
+    print(f"    total :      {done - start:.1f} s\n")
 
-def isearch_book(book, query_string, language):
+def indexTags(book, OTbooks):
+    """ tags of verses in book, for search within book list
     """
-    indexed search for English within book list (as filter)
+    if book in OTbooks:
+        return f"{book.replace(' ', '')}, OldTestament, AllBooks"
+    else:
+        return f"{book.replace(' ', '')}, NewTestament, AllBooks"
+
+def reindex_verse(book, chapter, verse, language):
     """
-    # first parameter to lower
-    book = book.lower()
+    update one verse in the index of language, eg after it is corrected,
+        instead of index_bible() all over again
+
+    the verse is marked stale first, in indexdir_{language}/stale, so if the
+        index is locked, eg index_bible() is writing it, it is updated later,
+        see reindex_stale()
+    """
+    if not os.path.exists(f"indexdir_{language}"):
+        return              # not indexed yet, nothing is out of date
+    with _staleLock:
+        with open(os.path.join(f"indexdir_{language}", 'stale'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps([book, chapter, verse]) + '\n')
+    if not reindex_stale(language, indexLockTimeout):
+        print(f"\n !!! Index in indexdir_{language} is locked, {book} {chapter}:{verse} is updated later !!!\n")
+
+def reindex_stale(language, timeout=0.0):
+    """
+    update the verses marked stale in the index of language, see reindex_verse(),
+        eg on the next correction, indexed search or index_bible(); they stay
+        marked while the index is locked, after waiting timeout seconds for it
+
+    return False if the index is locked
+    """
+    from whoosh.index import LockError
+
+    staleFile = os.path.join(f"indexdir_{language}", 'stale')
+    with _staleLock:
+        if not os.path.exists(staleFile):
+            return True
+        ix = indexManager.index(language)
+        if not getattr(ix.schema['id'], 'unique', False):
+            #   index_bible() indexes the text as corrected
+            print(f"\n !!! Index in indexdir_{language} can't be updated, please index bible again !!!\n")
+            os.remove(staleFile)
+            return True
+        verses = set()
+        with open(staleFile, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    verses.add(tuple(json.loads(line)))
+                except ValueError:      # eg half written line of a crashed run
+                    continue
+        try:
+            writer = ix.writer(timeout=timeout)
+        except LockError:
+            return False
+        bibletoUse = selectBible(language)
+        OTbooks = bookIndex(language).OTbooks
+        try:
+            for book, chapter, verse in sorted(verses):
+                writer.update_document(
+                    id = f"{book.replace(' ', '')} {chapter}:{verse}",
+                    content = bibletoUse[book][chapter][verse],
+                    tags = indexTags(book, OTbooks)
+                )
+        except BaseException:
+            writer.cancel()
+            raise
+        writer.commit()
+        os.remove(staleFile)
+    #   indexed search results of these verses are out of date; cached searcher
+    #       is refreshed on next search, as the index generation changed
+    searchCache.discard(lambda key: key[0] == language and key[3] == 'indexed')
+    return True
+
+def index_query(book, query_string, language):
+    """ whoosh query, and filter, of indexed search within book list, as in
+            isearch_book() for English and iCsearch_book() for Chinese
+    """
+    from whoosh.query import And, Phrase, Term
+
+    book = book.lower().replace(' ', '')
+    if language == 'zh-TW':
+        return And([Term("content", query_string), Term("tags", book)]), None
     query_string = query_string.lower()
+    phrase = query_string.split()
+    if len(phrase) > 1:
+        q1 = Phrase("content", phrase)
+    else:
+        q1 = Term("content", query_string.strip())
+    return q1, Term("tags", book)
+
+def isearch(book, query_string, language, limit=1000):
+    """
+    indexed search within book list, ie oldtestament, newtestament, allbooks, or a book
 
-    #   open the index
+    return a list of hits as defined by index Schema, ie [{id, content, tags}*]
+    """
     if not os.path.exists(f"indexdir_{language}"):
-        print(f"\n!!! No index dir found, I'm quitting ... !!!\n")
-        sys.exit(99)        
-    storage = FileStorage(f"indexdir_{language}")
-    ix = storage.open_index()
-
-    with ix.searcher() as s:
-        print(f"\nisearch in English ...")
-        phrase = query_string.split()
-        if len(phrase) > 1:
-            q1 = Phrase("content", phrase)
-        else: 
-            q1 = Term("content", query_string.strip())
-        print(f"\ntype of q1: {type(q1)}")
-        print(f"q1: {q1}")
-        q2 = Term("tags", book.replace(' ', ''))
-        print(f"\ntype of q2: {type(q2)}")
-        print(f"q2: {q2}")
-        results = s.search(q1, filter=q2, limit=1000)
-        print(f"isearch Results: {results}")
-        print(f"\nResults:")
-        total = len(results)
-        print(f"!!! Found {total} verses in {book} !!!")
-        page = 1
-        print(f"\nPage # {page}\n")  
-        for index in range(0, total):
-            r = results[index]
-            print(f"{r['id']} -- {r['content']}\n")
-            if (index + 1) % numberPerPage == 0 and (index+1) != total:
-                cont = input("continue y/n: ")
-                if cont == 'n' or cont == 'N':
-                    break
-                else:
-                    page = page + 1
-                    print(f"\nPage # {page}\n")
+        raise FileNotFoundError(f"No index dir found: indexdir_{language}")
+    reindex_stale(language)
+    #   results of an index that changed since, eg rebuilt by another process, are dropped
+    version = indexManager.version(language)
+    if _indexVersions.setdefault(language, version) != version:
+        searchCache.discard(lambda key: key[0] == language and key[3] == 'indexed')
+        _indexVersions[language] = version
+    key = (language, book.lower().replace(' ', ''), normalize_query(query_string, language, 'indexed'), 'indexed', limit, version)
+    hits = searchCache.get(key)
+    if hits is None:
+        q, qfilter = index_query(book, query_string, language)
+        with indexManager.using(language) as s:
+            hits = [hit.fields() for hit in s.search(q, filter=qfilter, limit=limit)]
+        searchCache.put(key, hits)
+    return hits
+
+def normalize_query(query_string, language, mode):
+    """ query as it is searched, so queries searched alike share a cache entry
+            keyword: lowercased, see SearchEngine.compile()
+            indexed: lowercased and single spaced for English, see index_query()
+    """
+    if mode == 'keyword' or language != 'zh-TW':
+        query_string = query_string.lower()
+    if mode == 'indexed' and language != 'zh-TW':
+        query_string = ' '.join(query_string.split())
+    return query_string
+
+def isearch_book(book, query_string, language):
+    """
+    indexed search for English within book list (as filter)
+    """
+    print(f"\nisearch in English ...")
+    print_hits(book, query_string, language)
 
 def iCsearch_book(book, query_string, language):
     """
     indexed search for Chinese within book list (as 2nd Term in query)
     """
-    # first parameter to lower
-    book = book.lower()
+    print(f"\n\nSearch in Chinese ...\n")
+    print_hits(book, query_string, language)
 
-    #   open the index
-    if not os.path.exists(f"indexdir_{language}"):
+def print_hits(book, query_string, language):
+    """
+    print hits of indexed search, numberPerPage at a time
+    """
+    try:
+        results = isearch(book, query_string, language)
+    except FileNotFoundError:
         print(f"\n!!! No index dir found, I'm quitting ... !!!\n")
         sys.exit(99)        
-    storage = FileStorage(f"indexdir_{language}")
-    ix = storage.open_index()
-
-    print(f"\n\nSearch in Chinese ...\n")
-    with ix.searcher() as s:
-        q1 = Term("content", query_string)
-        q2 = Term("tags", book.replace(' ', ''))
-        q = And([q1, q2])
-
-        results = s.search(q, limit=1000)
-        print(f"iCsearch Results: {results}")
-        print(f"\nResults:")
-        total = len(results)
-        print(f"!!! Found {total} verses in {book} !!!")
-        page = 1
-        print(f"\nPage # {page}\n")  
-        for index in range(0, total):
-            r = results[index]
-            print(f"{r['id']} -- {r['content']}")
-            global numberPerPage
-            if (index + 1) % numberPerPage == 0 and (index+1) != total:
-                cont = input("continue y/n: ")
-                if cont == 'n' or cont == 'N':
-                    break
-                else:
-                    page = page + 1
-                    print(f"\nPage # {page}\n")  
+    print(f"\nResults:")
+    total = len(results)
+    print(f"!!! Found {total} verses in {book.lower()} !!!")
+    page = 1
+    print(f"\nPage # {page}\n")  
+    for index in range(0, total):
+        r = results[index]
+        print(f"{r['id']} -- {r['content']}\n")
+        if (index + 1) % numberPerPage == 0 and (index+1) != total:
+            cont = input("continue y/n: ")
+            if cont == 'n' or cont == 'N':
+                break
+            else:
+                page = page + 1
+                print(f"\nPage # {page}\n")
 
 def indexSearch():
     """
@@ -246,6 +464,7 @@ def indexSearch():
         愛人如己
     """
  
+    ALLbooks = bookIndex(language).ALLbooks
     if language == "zh-TW":
         kw = input("Input search (Chinese) key words: ")
     else:
@@ -271,7 +490,7 @@ def indexSearch():
                 book = book.replace(' ', '')
             else:
                 print(f"\n!!! Invalid choice !!!\n")
-                print(random_verse(bible))
+                print(random_verse())
                 return
     print(f'Search "{kw}" in {book} ...')
     # do the task -- make call
@@ -280,17 +499,37 @@ def indexSearch():
     else:
         isearch_book(book, kw, 'en')
 
-def random_verse(bible_dc, book=False):
+def random_verse(bible_dc=None, book=False):
     """
     generate a random verse in English and Chinese
         bible_dc: we choose to ignore the passed bible version
     """
-    if not book:
-        book = random.choice(list(bible.keys()))
-    chapter = random.choice(list(bible[book].keys()))
-    verse = random.choice(list(bible[book][chapter].keys()))
+    bible, cbible = selectBible('en'), selectBible('zh-TW')
+    book, chapter, verse = random_ref(book)
     return f"{book} {chapter}:{verse}\n{bible[book][chapter][verse]}\n{cbible[book][chapter][verse]}"
 
+def random_ref(book=False, language='en'):
+    """ (book, chapter, verse) of a random verse, in book if given
+    """
+    bible_dc = selectBible(language)
+    if not book:
+        book = random.choice(list(bible_dc.keys()))
+    chapter = random.choice(list(bible_dc[book].keys()))
+    verse = random.choice(list(bible_dc[book][chapter].keys()))
+    return book, chapter, verse
+
+def random_pair(book=False):
+    """ (book, chapter, verse in en, verse in zh-TW) of a random verse of
+            either version, in book if given; a verse missing in a version,
+            eg 3 John 1:15 in KJV, is None, see alignment()
+    """
+    bible_dc = selectBible('en')
+    if not book:
+        book = random.choice(list(bible_dc.keys()))
+    chapter = random.choice(list(bible_dc[book].keys()))
+    verse_en, verse_zh = random.choice(alignment().pairs(book, chapter))
+    return book, chapter, verse_en, verse_zh
+
 def search_key(book, chapter, kw, language='zh-TW'):
     """ Keyword (kw) search on specified bible[book][chapter]
     
@@ -300,10 +539,7 @@ def search_key(book, chapter, kw, language='zh-TW'):
             [[id, content, tags]] ^^^^^
     """
 
-    bibletoUse = selectBible(language)
-    dic = bibletoUse[book][chapter]
-    patc = re.compile(kw.lower())
-    return [book, chapter, [k for k, v in dic.items() if patc.search(v.lower())]]
+    return searchEngine(language).search_chapter(book, chapter, kw)
 
 def search_booklist(bookList, kw, language='zh-TW'):
     """ Keyword (kw) search on specified bookList
@@ -311,15 +547,54 @@ def search_booklist(bookList, kw, language='zh-TW'):
     
     return list format: [ [book, chapter, [list of verses]]* ]
     """
-    #global bible, chapsInBook
-    result = []
-    for book in bookList:
-        for chapter in range(1, chapsInBook[book]+1):
-            _result = search_key(book, chapter, kw, language)
-            result.append(_result)
-    #   trim all empty verse list
-    result = [x for x in result if len(x[2]) > 0]
+    #   one pass over the flattened bible, chapters w/o hit are trimmed,
+    #       unless it is searched already
+    key = (language, tuple(bookList), normalize_query(kw, language, 'keyword'), 'keyword')
+    result = searchCache.get(key)
+    if result is None:
+        result = searchEngine(language).search(bookList, kw)
+        searchCache.put(key, result)
     return result
+
+def search_many(keywords, language='zh-TW', scope='all'):
+    """ Plain text (not regular expression) key words searched for all at
+            once, in one pass over scope, ie ot, nt, all or name of a book,
+            eg for a concordance of many words
+
+    return {kw: {'results': as in search_booklist(), 'verses': no. of verses,
+                 'occurrences': no. of times found, 'books': {book: no. of verses},
+                 'testaments': {'OT': no. of verses, 'NT': no. of verses}}}
+    """
+    bookList, _ = scope_books(scope, language)
+    OTbooks = set(bookIndex(language).OTbooks)
+    engine = searchEngine(language)
+    report = {}
+    for kw, hits in engine.search_many(bookList, keywords).items():
+        results = engine.group(hits)
+        books = {}
+        testaments = {'OT': 0, 'NT': 0}
+        for book, _, verses in results:
+            books[book] = books.get(book, 0) + len(verses)
+            testaments['OT' if book in OTbooks else 'NT'] += len(verses)
+        report[kw] = {'results': results, 'verses': len(hits), 'occurrences': sum(hits.values()),
+                      'books': books, 'testaments': testaments}
+    return report
+
+def searchEngine(language='zh-TW'):
+    """ Keyword search engine of the bible version based on language,
+            built once on first use
+    """
+    if language not in _searchEngines:
+        #   Chinese phrases are looked up in a bigram index, as there are no words to
+        #       split at, once it is built, see serve()
+        pool = None
+        if searchProcs != 1:
+            #   regular expressions are scanned for in worker processes, see searchpool.py
+            from searchpool import SearchPool
+            pool = SearchPool(englishText if language == 'en' else chineseText, language,
+                              journal.fileName, searchProcs, searchMinVerses)
+        _searchEngines[language] = SearchEngine(selectBible(language), ngram=language == 'zh-TW', pool=pool)
+    return _searchEngines[language]
     
 def search_OT(kw, language='zh-TW'):
     """ Keyword (kw) search on OT
@@ -328,7 +603,7 @@ def search_OT(kw, language='zh-TW'):
     return list format: [ [book, chapter, [list of verses]]* ]
     """
     #global OTbooks
-    return search_booklist(OTbooks, kw, language)
+    return search_booklist(bookIndex(language).OTbooks, kw, language)
 
 def search_NT(kw, language='zh-TW'):
     """ Keyword (kw) search on NT
@@ -337,7 +612,7 @@ def search_NT(kw, language='zh-TW'):
     return list format: [ [book, chapter, [list of verses]]* ]
     """
     #global NTbooks
-    return search_booklist(NTbooks, kw, language)
+    return search_booklist(bookIndex(language).NTbooks, kw, language)
 
 def search_ALL(kw, language='zh-TW'):
     """ Keyword (kw) search on ALLbooks
@@ -346,14 +621,14 @@ def search_ALL(kw, language='zh-TW'):
     return list format: [ [book, chapter, [list of verses]]* ]
     """
     #global ALLbooks
-    return search_booklist(ALLbooks, kw, language)
+    return search_booklist(bookIndex(language).ALLbooks, kw, language)
 
 def display_book(book, halt=False):
     """ Dispaly a book
     
     halt at the end of each chapter 
     """
-    #global bible, cbible, chapsInBook
+    chapsInBook = bookIndex().chapsInBook
     for chapter in range(1, chapsInBook[book]+1):
         display_chapter(book, chapter)
         if halt and (chapter < chapsInBook[book]):
@@ -366,26 +641,19 @@ def display_chapter(book, chapter, language='ALL'):
     #global bible, cbible
     print(f"\n{book}\t{chapter}:\n")
     if language == 'ALL':
-        # take care of some mis-matches, ie
-        # last verse may miss in some versions, eg
+        # verses are paired by alignment(), as some are missing in one version, eg
         #   John 7:53 in CUV, and
         #   3 John :15 in KJV
-        noVerses = max(len(bible[book][chapter]), len(cbible[book][chapter]))
-        for verse in range(1, noVerses+1):
-            try:
-                text_en = bible[book][chapter][verse]
-            except KeyError:
-                text_en = ''
-            try:
-                text_zh = cbible[book][chapter][verse]
-            except KeyError:
-                text_zh = ''
-            print(f"{verse} {text_en}")
-            print(f"{verse} {text_zh}\n")
+        bible, cbible = selectBible('en'), selectBible('zh-TW')
+        verses_en, verses_zh = bible[book][chapter], cbible[book][chapter]
+        for verse_en, verse_zh in alignment().pairs(book, chapter):
+            verse = verse_en or verse_zh
+            print(f"{verse} {verses_en[verse_en] if verse_en else ''}")
+            print(f"{verse} {verses_zh[verse_zh] if verse_zh else ''}\n")
     else:
         bibletoUse = selectBible(language)
-        for verse in range(1, len(bibletoUse[book][chapter])+1):
-            print(f"{verse} {bibletoUse[book][chapter][verse]}")     
+        for verse, text in bibletoUse[book][chapter].items():
+            print(f"{verse} {text}")
     print(f"^^^^^ {book}\tchapter {chapter} ^^^^^\n")
 
 def display_verse(book, chapter, verse, language=None):
@@ -397,6 +665,7 @@ def display_verse(book, chapter, verse, language=None):
         bibletoUse = selectBible(language)
         print (f"{bibletoUse[book][chapter][verse]}")
     else:   # verse in one language only
+        bible, cbible = selectBible('en'), selectBible('zh-TW')
         try:
             text_en = bible[book][chapter][verse]
         except KeyError:
@@ -408,40 +677,111 @@ def display_verse(book, chapter, verse, language=None):
         print(f"{verse} {text_en}")
         print(f"{verse} {text_zh}\n")
 
-def audio_book(book, language='zh-TW', engine='edge-tts', playAudio=False, halt=False):
+def display_refs(ref):
+    """ Display verses of a reference, eg 'John 3:16-18; Rom 8', both languages
+    """
+    for record in lookup_ref(ref):
+        print(f"\n{record['book']}  {record['chapter']}:{record['verse']}")
+        print(f"{record['verse']} {record.get('en', '')}")
+        print(f"{record['verse']} {record.get('zh-TW', '')}\n")
+
+def audio_book(book, language='zh-TW', engine='edge-tts', playAudio=False, halt=False, bookFile=False):
     """ Convert a book to audio files 
+
+    chapters are synthesized concurrently, unless they are played one by one,
+        and joined into one file of the book if bookFile
     """
-    for chapter in range(1, chapsInBook[book]+1):
-        audio_chapter(book, chapter, language, engine, playAudio)
-        if halt:
-            input("hit any key to continue")
+    chapsInBook = bookIndex(language).chapsInBook
+    if not playAudio:
+        summary = audio_chapters(book, range(1, chapsInBook[book]+1), language, engine)
+        if bookFile and summary and not summary.failed:
+            audio_book_file(book, language)
+        return summary
+    #   synthesize the next chapters while one is played
+    prefetcher = None
+    if prefetchChapters > 0:
+        import tts
+        ttsEngine = tts.make_engine(engine, language)
+        if ttsEngine is not None:
+            prefetcher = tts.Prefetcher(ttsEngine, audioCache, maxConcurrency, ttsRetries)
+    try:
+        for chapter in range(1, chapsInBook[book]+1):
+            if prefetcher:
+                prefetcher.wait(chapter_audio(book, chapter, language)[1])
+            audio_chapter(book, chapter, language, engine, playAudio)
+            if prefetcher:
+                last = min(chapter + prefetchChapters, chapsInBook[book])
+                prefetcher.prefetch([chapter_audio(book, c, language) for c in range(chapter+1, last+1)])
+            if halt and input("hit any key to continue, or q to stop ") in ('q', 'Q'):
+                break
+    finally:
+        if prefetcher:
+            prefetcher.close()
 
-def audio_chapter(book, chapter, language='zh-TW', engine='edge-tts', playAudio=True):
-    """ Convert a chapter in a book to audio, and
-            play it if choose so. 
+def audio_book_file(book, language='zh-TW'):
+    """ Join audio files of all chapters in a book into one, frame by frame
+    """
+    from audiocache import concat_mp3
+    shortBook = book.replace(" ", "")
+    chapters = range(1, bookIndex(language).chapsInBook[book]+1)
+    fileName = f"./audio/{language}/{shortBook}/{shortBook}.mp3"
+    concat_mp3([chapter_audio(book, chapter, language)[1] for chapter in chapters], fileName)
+    return fileName
+
+def audio_chapters(book, chapters, language='zh-TW', engine='edge-tts'):
+    """ Convert chapters in a book to audio files, concurrently
+
+    each chapter is joined from the audio of its title and verses, and
+        only those not in audioCache are synthesized
+    return summary of generated, cached and failed files
     """
+    import tts
+    ttsEngine = tts.make_engine(engine, language)
+    if ttsEngine is None:
+        return None
+    jobs = [chapter_audio(book, chapter, language) for chapter in chapters]
+    summary = tts.run_assembly(jobs, ttsEngine, audioCache, maxConcurrency, ttsRetries)
+    print(summary)
+    return summary
 
+def chapter_audio(book, chapter, language='zh-TW'):
+    """ segments, ie title and verses, and audio file name of a chapter in a book
+    """
     #   strip whitespace in book name
     shortBook = book.replace(" ", "")
     #   add book name and chapter # in audio
     title = str(book) + " chapter " + str(chapter)
     #   select the bible version for audio
     bibletoUse = selectBible(language)
-    #   compose verseList by scaning all verses in 'bibletoUse[book][chapter]' -- some verses are missing in other language version, eg CUN
-    verseList = []
-    for verse in range(1, len(bibletoUse[book][chapter])+1):
-        verse in bibletoUse[book][chapter] and verseList.append(verse)
-    text = "\n".join(bibletoUse[book][chapter][verse]  for verse in verseList )
-    display_chapter(book, chapter, language)
+    #   all verses in 'bibletoUse[book][chapter]', read as one slice -- some verses are missing in other language version, eg CUN
+    verses = bibletoUse[book][chapter].values()
     #   mkdir if it does not exist
     Path(f"./audio/{language}/{shortBook}").mkdir(parents=True, exist_ok=True)
     fileName = f"./audio/{language}/{shortBook}/{shortBook}_{chapter}.mp3"
-    audioFile = Path(fileName)
-    #   create audio file only if it does not exits
-    if ( not audioFile.exists() ):
-        text2Audio(title+text, fileName, language, engine)
-    if ( playAudio ):
-        playAudioFile(fileName, platform.system())
+    return [title] + verses, fileName
+
+def audio_chapter(book, chapter, language='zh-TW', engine='edge-tts', playAudio=True):
+    """ Convert a chapter in a book to audio, and
+            play it if choose so. 
+    """
+
+    display_chapter(book, chapter, language)
+    if ( playAudio and streamAudio and platform.system() in ["Linux"] ):
+        #   play while the audio is being synthesized
+        import tts
+        ttsEngine = tts.make_engine(engine, language)
+        if ttsEngine is None:
+            return None
+        segments, fileName = chapter_audio(book, chapter, language)
+        summary = tts.stream_play(segments, fileName, ttsEngine, audioCache, player)
+        if summary.failed:
+            print(summary)
+        return
+    #   create audio file only if it is not the audio of the chapter already,
+    #       from audio of its verses
+    summary = audio_chapters(book, [chapter], language, engine)
+    if ( playAudio and summary and not summary.failed ):
+        playAudioFile(chapter_audio(book, chapter, language)[1], platform.system())
 
 def audio_verse(book, chapter, verse, language='zh-TW', engine='edge-tts'):
     """ Play audio of a verse in the bible 
@@ -455,14 +795,14 @@ def audio_verse(book, chapter, verse, language='zh-TW', engine='edge-tts'):
         ic(f"No verse {book} {chapter}:{verse} in {language} bible version")
         return
     display_verse(book, chapter, verse, language)
-    shortBook = book.replace(" ", "")
-    #   mkdir if it does not exist
-    Path(f"./audio/tmp/{language}").mkdir(parents=True, exist_ok=True)
-    fileName = f"./audio/tmp/{language}/{shortBook}_{chapter}_{verse}.mp3"
-    audioFile = Path(fileName)
+    import tts
+    #   verse audio is named by what it is made from, see audiocache.py
+    fileName = audioCache.verse_path(tts.audio_key(audioCache, text, language, engine), language)
     #   create audio file only if it does not exits
-    if ( not audioFile.exists() ):
-        text2Audio(text, fileName, language, engine)
+    text2Audio(text, fileName, language, engine)
+    #   keep verse audio within budget
+    audioCache.evict()
+    audioCache.save()
     playAudioFile(fileName, platform.system())
 
 def text2Audio(text, fileName, language='zh-TW', engine='edge-tts'):
@@ -470,42 +810,24 @@ def text2Audio(text, fileName, language='zh-TW', engine='edge-tts'):
         text to audio based on:
             1. edge-tts/MS, or
             2. gtts/google
+        see tts.py, unless fileName is intact audio of text already
     """
-    missing_tts_engine = False
-    if engine == 'gtts':
-        try:
-            from gtts import gTTS
-        except ImportError:
-            missing_tts_engine = True
-        if missing_tts_engine:
-            print(f"\n !!! No TTS engine installed !!!")
-            print(f"     !!!! Please install gtts !!!!\n")
-            return None
-        audioObj = gTTS(text=text, lang=language, lang_check=False)
-        audioObj.save(fileName)
-    else:   #   edge-tts
-        try:
-            import edge_tts
-        except ImportError:
-            missing_tts_engine = True
-        if missing_tts_engine:
-            print(f"\n !!! No TTS engine installed !!!")
-            print(f"     !!!! Please install edge-tts !!!!\n")
-            return None
-        if language == 'zh-TW':
-            voice = 'zh-TW-HsiaoYuNeural'
-        else:
-            voice = 'en-US-AriaNeural'
-        communicate = edge_tts.Communicate(text, voice)
-        communicate.save_sync(fileName)
-        
+    import tts
+    ttsEngine = tts.make_engine(engine, language)
+    if ttsEngine is None:
+        return None
+    summary = tts.run_synthesis([(text, fileName)], ttsEngine, 1, ttsRetries, cache=audioCache)
+    if summary.failed:
+        print(summary)
+
 
 def playAudioFile(fileName, osType):
     """ Play audio fileName using OS features
     """
     if osType in ["Linux"]:
         global player
-        os.system(f"{player} {fileName} 2>/dev/null &")
+        import tts
+        tts.start_player(player, fileName)
     elif osType in ["Windows"]:
         __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
         os.startfile(os.path.join(__location__, fileName))
@@ -513,17 +835,68 @@ def playAudioFile(fileName, osType):
         ic(f"Please inform me how to play audio file in {osType}")
 
 def selectBible(language='zh-TW'):
-    """ Select the bible text version for audio based on language
+    """ Select the bible text version for audio based on language,
+            loaded on first use
     """
-    if ( language == 'en' ):
-        return bible
-    else:
-        return cbible
+    if ( language != 'en' ):
+        language = 'zh-TW'
+    if language not in _bibles:
+        bibletoUse = load_corpus(englishText if language == 'en' else chineseText)
+        #   corrections made since the text file was written
+        journal.replay(bibletoUse, language)
+        _bibles[language] = bibletoUse
+    return _bibles[language]
+
+def alignment():
+    """ Alignment of verses of en-bible and zh-bible, see alignment.py
+
+    loaded from alignmentFile, or built, and saved, if that is not built
+        from the text files as they are now
+    """
+    global _alignment
+    if _alignment is None:
+        _alignment = load_alignment(alignmentFile, englishText, chineseText)
+        if _alignment is None:
+            _alignment = Alignment.build(selectBible('en'), selectBible('zh-TW'),
+                                         sources=stamp([englishText, chineseText]))
+            try:
+                _alignment.save(alignmentFile)
+            except OSError as e:
+                print(f"\n!!! Alignment not saved to {alignmentFile}: {e} !!!\n")
+    return _alignment
+
+def bookIndex(language='zh-TW'):
+    """ OTbooks, NTbooks, ALLbooks and chapsInBook, constructed on first use
+
+    books and chapters are the same in both versions, so use the one loaded
+        already, or else the one of language
+    """
+    global _bookIndex
+    if _bookIndex is None:
+        bible_dc = next(iter(_bibles.values())) if _bibles else selectBible(language)
+        #
+        # i am lazy, so let the computer construct some global variables
+        #
+        OTbooks = []            # books in OT
+        NTbooks = []            # books in NT
+        ALLbooks = []           # all books in bible
+        chapsInBook = {}        # no. of chapters in each book
+        _count = 0
+        for book in bible_dc.keys():
+            chapsInBook[book] = len(bible_dc[book])
+            ALLbooks.append(book)
+            _count = _count + 1
+            if _count <= 39:    # 39 is the only variable i need to remember: # books in OT
+                OTbooks.append(book)
+            else:
+                NTbooks.append(book)
+        _bookIndex = BookIndex(OTbooks, NTbooks, ALLbooks, chapsInBook)
+    return _bookIndex
 
 def test0():
     """ test on global variables """
     
-    #global ALLbooks, OTbooks, NTbooks, chapsInBook
+    OTbooks, NTbooks, ALLbooks, chapsInBook = bookIndex()
     print(f"Test 0: ")
     print("\nAll books in bible:")
     print(ALLbooks)
@@ -534,21 +907,15 @@ def test0():
     print("\nChapters in Books:")
     for book in ALLbooks:
         print(f"{book} : {chapsInBook[book]}")
-        # check if verses in each book of  en-bible and zh-bible are equal
-        for chapter in range(1, chapsInBook[book]+1):
-            len_en = len(bible[book][chapter])
-            len_zh = len(cbible[book][chapter])
-            if (len_en == len_zh):
-                #print(f"    {book}:{chapter} OK")
-                pass
-            else:
-                print(f"    {book}:{chapter} Diff {len_en} <--> {len_zh}")                
+        # chapters of which verses in en-bible and zh-bible are not the same
+        for _book, chapter, len_en, len_zh in alignment().mismatches(book):
+            print(f"    {book}:{chapter} Diff {len_en} <--> {len_zh}")                
     print(f"--- End of Test 0 ---\n")
 
 def test1():
     """ test on basic functions """
     
-    #global bible    
+    bible, cbible = selectBible('en'), selectBible('zh-TW')
     # test to print John 3:16
     print(f"Test 1: ")
     print("\nprint John 3:16")
@@ -557,11 +924,11 @@ def test1():
     
     # test of random_verse
     print("\nrandom_verse")
-    print(random_verse(bible))
+    print(random_verse())
 
     # test of random_verse on book Acts
     print("\nrandom_verse on book Acts")
-    print(random_verse(bible, 'Acts'))
+    print(random_verse(book='Acts'))
     
     # test of display 1 Jone 5
     print("\ndisplay 1 John Chapter 5")
@@ -573,6 +940,7 @@ def test1():
 def test_search():
     """ test on search functions """
 
+    bible, cbible = selectBible('en'), selectBible('zh-TW')
     print(f"Test of search: ")
     # test of search on book John chapter 3
     print("\nsearch on word 'God' in John chapter 3")
@@ -599,30 +967,140 @@ def test_search():
             print('{0} {1}:{2} \n{3}'.format(book, chapter, verse, bible[book][chapter][verse]))
             print('{0} {1}:{2} \n{3}\n'.format(book, chapter, verse, cbible[book][chapter][verse]))
     print(f"--- End of Test search ---\n")
-            
+
+def test_references():
+    """ test on parsing of references """
+
+    P = references.Passage
+    print(f"Test of references: ")
+    cases = {
+        'John 3:16-18': [P('John', 3, 16, 3, 18)],
+        'Ps 23:1-3, 5': [P('Psalms', 23, 1, 23, 3), P('Psalms', 23, 5, 23, 5)],
+        'John 3:16-4:2': [P('John', 3, 16, 4, 2)],
+        'Rom 8; 9': [P('Romans', 8, None, 8, None), P('Romans', 9, None, 9, None)],
+        '約 3:16；羅 8': [P('John', 3, 16, 3, 16), P('Romans', 8, None, 8, None)],
+        'i john 5': [P('1 John', 5, None, 5, None)],
+        'Jude': [P('Jude', None, None, None, None)],
+    }
+    for text, passages in cases.items():
+        assert references.parse(text) == passages, text
+        print(f"{text} : {passages}")
+    for text in ('Nobook 1', '3:16', 'Jo 1', 'John 3:x'):
+        try:
+            references.parse(text)
+        except ValueError as e:
+            print(f"{text} : {e}")
+        else:
+            raise AssertionError(f"{text} is not a reference")
+    print(f"--- End of Test references ---\n")
+
+def test_concordance():
+    """ test on Aho-Corasick automaton of key words """
+
+    from concordance import Automaton
+    print(f"Test of concordance: ")
+    found = Automaton(['he', 'she', 'his', 'hers']).scan(['ushers', 'this he', 'none'], 0, 3)
+    print(found)
+    assert found == [{0: 1, 1: 1}, {0: 1}, {1: 1}, {0: 1}]
+    #   overlapping occurrences are all counted
+    assert Automaton(['aa']).scan(['aaaa'], 0, 1) == [{0: 3}]
+    print(f"--- End of Test concordance ---\n")
+
+def test_audio():
+    """ test on mp3 frames, and synthesis with retries and a concurrency limit,
+            by a fake TTS engine, in a temporary directory
+    """
+    import tempfile
+    import tts
+    from audiocache import concat_mp3, mp3_duration, mp3_frames
+
+    class CountingTTS(tts.FakeTTS):
+        """ FakeTTS which counts the calls running at once """
+        running = maxRunning = 0
+        async def stream(self, text):
+            self.running += 1
+            self.maxRunning = max(self.maxRunning, self.running)
+            try:
+                async for data in super().stream(text):
+                    yield data
+            finally:
+                self.running -= 1
+
+    print(f"Test of audio: ")
+    with tempfile.TemporaryDirectory() as directory:
+        #   mp3 frames, ID3v2 tag skipped, truncation found, joined frame by frame
+        frame = tts.FakeTTS.FRAME
+        tag = b'ID3\x04\x00\x00\x00\x00\x00\x05' + bytes(5)
+        assert [f[:2] for f in mp3_frames(tag + frame * 3)] == [(15, 417), (432, 417), (849, 417)]
+        assert abs(mp3_duration(frame * 3) - 3 * 1152 / 44100) < 1e-9
+        try:
+            mp3_frames(frame * 2 + frame[:100])
+        except ValueError as e:
+            print(f"truncated mp3 : {e}")
+        else:
+            raise AssertionError("truncated mp3 is not found")
+        parts = [os.path.join(directory, f"part{n}.mp3") for n in range(2)]
+        for n, part in enumerate(parts):
+            with open(part, 'wb') as f:
+                f.write(tag + frame * (n + 1))
+        concat_mp3(parts, os.path.join(directory, 'joined.mp3'))
+        with open(os.path.join(directory, 'joined.mp3'), 'rb') as f:
+            assert f.read() == frame * 3
+        print("mp3 frames : OK")
+
+        #   the first 2 calls fail, and are retried after 0.01, 0.02 seconds
+        engine = CountingTTS('en', failures=2)
+        started = time.perf_counter()
+        summary = tts.run_synthesis([('In the beginning', os.path.join(directory, 'retry.mp3'))],
+                                    engine, retries=3, backoff=0.01)
+        print(f"retries : {engine.calls} calls, {summary}")
+        assert summary.generated and engine.calls == 3
+        assert time.perf_counter() - started >= 0.03
+        #   more failures than retries
+        engine = CountingTTS('en', failures=5)
+        summary = tts.run_synthesis([('In the beginning', os.path.join(directory, 'failed.mp3'))],
+                                    engine, retries=1, backoff=0.01)
+        assert not summary.generated and len(summary.failed) == 1 and engine.calls == 2
+        #   no more than max_concurrency calls at once, and files there are skipped
+        engine = CountingTTS('en', delay=0.01)
+        jobs = [(f"verse {n}", os.path.join(directory, f"verse{n}.mp3")) for n in range(12)]
+        summary = tts.run_synthesis(jobs, engine, max_concurrency=3, backoff=0.01)
+        print(f"concurrency : at most {engine.maxRunning} of 3 at once, {summary}")
+        assert len(summary.generated) == 12 and engine.maxRunning == 3
+        summary = tts.run_synthesis(jobs, engine, max_concurrency=3, backoff=0.01)
+        assert len(summary.cached) == 12 and engine.calls == 12
+    print(f"--- End of Test audio ---\n")
+
 def quit():
     sys.exit(0)
 
 def listOTbooks():
-    #global OTbooks
+    OTbooks = bookIndex(language).OTbooks
     print('Books in Old Testament:\n')
     print(', '.join(OTbooks))
 
 def listNTbooks():
-    #global NTbooks
+    NTbooks = bookIndex(language).NTbooks
     print('Books in New Testament:\n')
     print(', '.join(NTbooks))
     
 def displayText():
-    #global ALLbooks, chapsInBook, bible
+    OTbooks, NTbooks, ALLbooks, chapsInBook = bookIndex(language)
     #
     # input book
     #
-    book = input("Input name of the book: ")
+    book = input("Input name of the book, or references, eg John 3:16-18; Rom 8: ")
     if (book not in ALLbooks):
-        print("\nbook must be one of --\n{0}\n".format(ALLbooks))
-        print(random_verse(bible))
-        return
+        try:
+            passages = references.parse(book)
+            if len(passages) > 1 or passages[0].chapter is not None:
+                display_refs(book)
+                return
+            book = passages[0].book     # abbreviation or chinese name of the book
+        except (ValueError, KeyError):
+            print("\nbook must be one of --\n{0}\n".format(ALLbooks))
+            print(random_verse())
+            return
     #
     # input chapter
     #
@@ -637,7 +1115,7 @@ def displayText():
                 print('\nThere is only one chapter in the book of {0}.\n'.format(book))
             else:
                 print('\nThere are {0} chapters in the book of {1}.\n'.format(chapsInBook[book], book))
-            print(random_verse(bible, book))
+            print(random_verse(book=book))
             return
         else:                       # chapter OK, then input verse
             _tmp = input("Input the verse no.: ")
@@ -650,18 +1128,19 @@ def displayText():
                     return
                 except:             # something went wrong with the verse
                     print('\nYour selection is not in the Bible!\n')
-                    print(random_verse(bible, book))
+                    print(random_verse(book=book))
 
 def correctVerse():
     """
     correct one verse
     """
+    OTbooks, NTbooks, ALLbooks, chapsInBook = bookIndex(language)
     # input book
     #
     book = input("Input name of the book: ")
     if (book not in ALLbooks):
         print("\nbook must be one of --\n{0}\n".format(ALLbooks))
-        print(random_verse(bible))
+        print(random_verse())
         return
     # input chapter
     #
@@ -672,7 +1151,7 @@ def correctVerse():
             print('\nThere is only one chapter in the book of {0}.\n'.format(book))
         else:
             print('\nThere are {0} chapters in the book of {1}.\n'.format(chapsInBook[book], book))
-        print(random_verse(bible, book))
+        print(random_verse(book=book))
         return
     # verse
     #
@@ -682,7 +1161,7 @@ def correctVerse():
         display_verse(book, chapter, verse, language)
     except:     # something went wrong with the verse
         print(f"\nVerse {verse} is not in {book} {chapter}!\n")
-        print(random_verse(bible, book))
+        print(random_verse(book=book))
         return
     # correction
     #
@@ -693,23 +1172,40 @@ def correctVerse():
     newtext = input(f"\nInput corrected verse for {book} {chapter}:{verse} :\n")
     decision = input(f"REPLACING \n{oldtext}\n with \n{newtext}\n----- y/n?")
     if decision == 'y' or decision == 'Y':
-        bibletoUse[book][chapter][verse] = newtext
-        # update packle file
-        pkl_file = 'cbible.pkl' if language == 'zh-TW' else 'bible.pkl'
-        f = open(pkl_file, 'wb')
-        pickle.dump(bibletoUse, f)
-        f.close()
+        set_verse(book, chapter, verse, newtext, language)
+
+def set_verse(book, chapter, verse, text, language='zh-TW'):
+    """ Change the text of a verse, and keep everything built on the text up to date
+    """
+    bibletoUse = selectBible(language)
+    bibletoUse[book][chapter][verse] = text
+    #   search engine, and results of both keyword and indexed search, are now out of date
+    engine = _searchEngines.pop(language, None)
+    if engine is not None and engine.pool is not None:
+        engine.pool.shutdown()
+    searchCache.discard(lambda key: key[0] == language)
+    #   log it, the text file is updated by compactCorrections()
+    journal.append(language, book, chapter, verse, text)
+    #   and the verse in index
+    reindex_verse(book, chapter, verse, language)
 
 
+def compactCorrections():
+    """ Fold logged corrections into the text files, pickle or binary corpus
+    """
+    for lang, textFile in (('en', englishText), ('zh-TW', chineseText)):
+        count = journal.compact(lang, textFile)
+        print(f"{count} correction/s of {lang} folded into {textFile}")
+
 def audioText():
-    #global ALLbooks, chapsInBook, bible
+    OTbooks, NTbooks, ALLbooks, chapsInBook = bookIndex(language)
     #
     # input book
     #
     book = input("Input name of the book: ")
     if (book not in ALLbooks):
         print("\nbook must be one of --\n{0}\n".format(ALLbooks))
-        print(random_verse(bible))
+        print(random_verse())
         return
     #
     # input chapter/s
@@ -723,19 +1219,18 @@ def audioText():
         chapters = [ c for c in range(int(first), int(last)+1) ]
     else:                   # book+chapters in kind of csv format
         chapters = [ int(x) for x in _tmp.split(',') ]
-    # only play the audio if a single chapter is selected
-    if len(chapters) > 1:
-        playAudio = False
-    else:
-        playAudio = True
     for chapter in chapters:
         if (chapter > chapsInBook[book] or chapter < 1):
             print(f"\n!!! There are {chapsInBook[book]} chapter/s in the book of {book}. !!!")
             print(f"      Not able to locate chapter {chapter} in {book}\n")
-            print(random_verse(bible, book))
+            print(random_verse(book=book))
             return
-        #   chapter # is OK
-        audio_chapter(book, chapter, language, engine, playAudio)  # audio book+chapter
+    #   chapter #s are OK
+    # only play the audio if a single chapter is selected
+    if len(chapters) > 1:
+        audio_chapters(book, chapters, language, engine)    # audio book+chapters, concurrently
+    else:
+        audio_chapter(book, chapters[0], language, engine, True)  # audio book+chapter
              
 def configLanguage():
     """ Configure language for audio/search
@@ -766,6 +1261,8 @@ def configEngine():
         engine = 'edge-tts'
 
 def search():
+    bible, cbible = selectBible('en'), selectBible('zh-TW')
+    ALLbooks = bookIndex(language).ALLbooks
     kw = input("Input search key words: ")
     print("""
     Search in old testament,
@@ -791,7 +1288,7 @@ def search():
                 print(f"Book: {book}")
             else:
                 print(f"\n!!! Invalid choice !!!\n")
-                print(random_verse(bible))
+                print(random_verse())
                 return
     #   a summary of results
     total = 0
@@ -826,7 +1323,10 @@ def testAll():
     test0()
     test1()
     test_search()
-   
+    test_references()
+    test_concordance()
+    test_audio()
+
 def main():
 
     PROMPT = """
@@ -840,10 +1340,13 @@ def main():
     I/i Index bible for search
     Z/z New Search using index
     C/c Correct bible verse
+    K/k Compact corrections into bible text files
     T/t Tests
     Q/q. Exit
     """
 
+    #   list all config
+    _cfg.list_config()
     while True:
         print(f"\n  Audio/Search language configure/selected: {language}")
         print(f"  Text-to-Speek engine configure/selected:  {engine}")
@@ -861,9 +1364,294 @@ def main():
             case 'L' | 'l': configLanguage()
             case 'E' | 'e': configEngine()
             case 'C' | 'c': correctVerse()
+            case 'K' | 'k': compactCorrections()
             case 'Q' | 'q': quit()
             case _: continue
 
+def lookup_refs(refs, languages=('en', 'zh-TW')):
+    """ verses of many references, eg 'John 3:16-18; Rom 8; Ps 23:1-3, 5', see
+            references.py, in languages; each range of verses is read as one
+            slice of each bible, not verse by verse
+
+    return {reference: [{book, chapter, verse, language: text*}*]}
+    raise ValueError if ref is not a reference, KeyError if it is not in the bible
+    """
+    result = {}
+    for ref in refs:
+        if ref in result:
+            continue
+        records = result[ref] = []
+        for passage in references.parse(ref):
+            verses = {}     # (chapter, verse) -> record, of a passage in either language
+            for lang in languages:
+                bibletoUse = selectBible(lang)
+                _add_verses(verses, lang, bibletoUse, *references.resolve(bibletoUse, passage))
+            if not verses:
+                raise KeyError(f"{ref}")
+            records.extend(verses[key] for key in sorted(verses))
+    return result
+
+def lookup_chapter(book, chapter, languages=('en', 'zh-TW')):
+    """ verses of a chapter, by number, unlike a reference, eg Jude 3, which
+            is a verse of a book of one chapter
+
+    return [{book, chapter, verse, language: text*}*], as in lookup_refs()
+    raise KeyError if there is no such book or chapter
+    """
+    verses = {}
+    for lang in languages:
+        bibletoUse = selectBible(lang)
+        try:
+            _add_verses(verses, lang, bibletoUse, *bibletoUse.chapter_range(book, chapter))
+        except KeyError:
+            raise KeyError(f"No chapter {chapter} in {book}") from None
+    return [verses[key] for key in sorted(verses)]
+
+def _add_verses(verses, lang, bibletoUse, first, last):
+    """ text of verse ids first .. last-1 of bibletoUse (in lang) into verses,
+            ie {(chapter, verse): record}, read as one slice
+    """
+    for (book, chapter, verse), text in zip(bibletoUse.refs(first, last), bibletoUse.texts(first, last)):
+        verses.setdefault((chapter, verse), {'book': book, 'chapter': chapter, 'verse': verse})[lang] = text
+
+def lookup_ref(ref, languages=('en', 'zh-TW')):
+    """ verses of a reference, see lookup_refs()
+    """
+    return lookup_refs([ref], languages)[ref]
+
+def scope_books(scope, language='zh-TW'):
+    """ books of a search scope, ie ot, nt, all, or name of a book
+
+    return (book list, book as of indexed search)
+    """
+    books = bookIndex(language)
+    scopes = {'ot': (books.OTbooks, 'oldtestament'), 'nt': (books.NTbooks, 'newtestament'),
+              'all': (books.ALLbooks, 'allbooks')}
+    if scope.lower() in scopes:
+        return scopes[scope.lower()]
+    book = references.book_name(scope)
+    return [book], book
+
+def serve(host='127.0.0.1', port=8000):
+    """ Serve verses, searches and random verses as JSON over http, see server.py
+
+        GET /verse?ref=John 3:16-18; Rom 8&lang=ALL
+        GET /chapter?book=John&chapter=3&lang=en
+        GET /search?q=愛人如己&lang=zh-TW&scope=nt
+        GET /isearch?q=愛人如己&lang=zh-TW&scope=all
+        GET /random?lang=ALL&book=Psalms
+        GET /metrics
+
+    both texts (and search engines) are loaded before serving, and stay so
+    """
+    import server           # asyncio, only when serving
+    def languages(params):
+        lang = params.get('lang', 'ALL')
+        if lang not in ('en', 'zh-TW', 'ALL'):
+            raise ValueError(f"No such language: {lang}")
+        return ('en', 'zh-TW') if lang == 'ALL' else (lang,)
+
+    def search_language(params):
+        lang = params.get('lang', language)
+        if lang not in ('en', 'zh-TW'):
+            raise ValueError(f"No such language: {lang}")
+        if not params.get('q'):
+            raise ValueError("No query, q")
+        return lang
+
+    def verse(params):
+        ref = params.get('ref')
+        if not ref:
+            raise ValueError("No reference, ref")
+        return {'ref': ref, 'verses': lookup_ref(ref, languages(params))}
+
+    def chapter(params):
+        ref = f"{params.get('book', '')} {params.get('chapter', '')}"
+        if not params.get('chapter', '').isdigit():
+            raise ValueError(f"Not a chapter: {ref}")
+        book = references.book_name(params.get('book', ''))
+        return {'ref': ref, 'verses': lookup_chapter(book, int(params['chapter']), languages(params))}
+
+    def search(params):
+        lang = search_language(params)
+        bookList, _ = scope_books(params.get('scope', 'all'), lang)
+        try:
+            result = search_booklist(bookList, params['q'], lang)
+        except re.error as e:
+            raise ValueError(f"Bad pattern: {e}")
+        return {'query': params['q'], 'count': sum(len(verses) for _, _, verses in result), 'results': result}
+
+    def isearch_(params):
+        lang = search_language(params)
+        _, iscope = scope_books(params.get('scope', 'all'), lang)
+        try:
+            hits = isearch(iscope, params['q'], lang, int(params.get('limit', 1000)))
+        except FileNotFoundError as e:
+            raise server.HTTPError(503, str(e))
+        return {'query': params['q'], 'count': len(hits), 'results': hits}
+
+    def random_(params):
+        langs = languages(params)
+        book = False
+        if params.get('book'):
+            book = references.book_name(params['book'])
+        if len(langs) == 1:
+            book, chapter, verse = random_ref(book, langs[0])
+            return {'book': book, 'chapter': chapter, 'verse': verse, langs[0]: selectBible(langs[0])[book][chapter][verse]}
+        #   a verse of either version, '' in the one it is missing in, as in display_chapter()
+        book, chapter, verse_en, verse_zh = random_pair(book)
+        return {'book': book, 'chapter': chapter, 'verse': verse_en or verse_zh,
+                'en': selectBible('en')[book][chapter][verse_en] if verse_en else '',
+                'zh-TW': selectBible('zh-TW')[book][chapter][verse_zh] if verse_zh else ''}
+
+    for lang in ('en', 'zh-TW'):
+        selectBible(lang)
+        if searchEngine(lang).ngram:
+            searchEngine(lang).phrase_index()
+        bookIndex(lang)
+    routes = {'/verse': verse, '/chapter': chapter, '/search': search, '/isearch': isearch_, '/random': random_}
+    server.JSONServer(routes, host, port, max_concurrency=int(_cfg.get_config('SERVER', 'workers', 8)),
+                      cache_entries=int(_cfg.get_config('SERVER', 'cache_entries', 1024)),
+                      uncached={'/random'}, metrics=lambda: {'search_cache': searchCache.stats()},
+                      versions={'/isearch': lambda: (indexManager.version('en'), indexManager.version('zh-TW'))}
+                      ).serve_forever()
+
+def _read_args(items, fileName):
+    """ items from command line, and then one per line from fileName ('-' for stdin)
+    """
+    yield from items
+    if fileName:
+        f = sys.stdin if fileName == '-' else open(fileName, encoding='utf-8')
+        with f:
+            for line in f:
+                if line.strip():
+                    yield line.strip()
+
+def _emit(out, record):
+    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def cli(argv=None):
+    """ Batch (non-interactive) use, eg
+
+        python bible.py search -l en -s nt "what wilt thou"
+        python bible.py show -f refs.txt
+        python bible.py audio -l zh-TW "Ruth 1" Jude
+        python bible.py index -l en
+
+    results are written as json lines, all else goes to stderr, and
+        texts and indexes are loaded once for all queries
+    """
+    global language
+    parser = argparse.ArgumentParser(prog='pybible', description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('search', help='keyword (or indexed) search, one json line per verse found')
+    p.add_argument('keywords', nargs='*')
+    p.add_argument('-f', '--file', help="keywords, one per line, '-' for stdin")
+    p.add_argument('-l', '--language', choices=['zh-TW', 'en'], default=language)
+    p.add_argument('-s', '--scope', default='all', help='ot, nt, all, or name of a book')
+    p.add_argument('-i', '--indexed', action='store_true', help='use the index, see index')
+    p.add_argument('-c', '--counts', action='store_true',
+                   help='counts by book and testament of plain text key words, all found in one pass')
+    p = sub.add_parser('show', help="verses of references, eg 'John 3:16-18', one json line per verse")
+    p.add_argument('refs', nargs='*')
+    p.add_argument('-f', '--file', help="references, one per line, '-' for stdin")
+    p.add_argument('-l', '--language', choices=['zh-TW', 'en', 'ALL'], default='ALL')
+    p = sub.add_parser('audio', help="audio files of books or chapters, eg 'Ruth' or 'Ruth 1'")
+    p.add_argument('refs', nargs='*')
+    p.add_argument('-f', '--file', help="references, one per line, '-' for stdin")
+    p.add_argument('-l', '--language', choices=['zh-TW', 'en'], default=language)
+    p.add_argument('-e', '--engine', choices=['edge-tts', 'gtts'], default=engine)
+    p = sub.add_parser('index', help='index bible for indexed search')
+    p.add_argument('-l', '--language', choices=['zh-TW', 'en'], default=language)
+    p = sub.add_parser('serve', help='serve verses and searches as json over http, see serve()')
+    p.add_argument('--host', default=_cfg.get_config('SERVER', 'host', '127.0.0.1'))
+    p.add_argument('--port', type=int, default=int(_cfg.get_config('SERVER', 'port', 8000)))
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    status = 0
+    with redirect_stdout(sys.stderr):
+        match args.command:
+            case 'search':
+                try:
+                    bookList, iscope = scope_books(args.scope, args.language)
+                except ValueError as e:
+                    _emit(out, {'scope': args.scope, 'error': str(e)})
+                    return 1
+                bibletoUse = selectBible(args.language)
+                if args.counts:
+                    try:
+                        report = search_many(_read_args(args.keywords, args.file), args.language, args.scope)
+                    except ValueError as e:
+                        _emit(out, {'error': str(e)})
+                        return 1
+                    for kw, counts in report.items():
+                        _emit(out, {'query': kw, **{k: v for k, v in counts.items() if k != 'results'}})
+                    out.flush()
+                    return status
+                for kw in _read_args(args.keywords, args.file):
+                    try:
+                        if args.indexed:
+                            for hit in isearch(iscope, kw, args.language):
+                                _emit(out, {'query': kw, 'id': hit['id'], 'text': hit['content']})
+                        else:
+                            for book, chapter, verses in search_booklist(bookList, kw, args.language):
+                                for verse in verses:
+                                    _emit(out, {'query': kw, 'book': book, 'chapter': chapter, 'verse': verse,
+                                                'text': bibletoUse[book][chapter][verse]})
+                    except (re.error, FileNotFoundError) as e:
+                        _emit(out, {'query': kw, 'error': str(e)})
+                        status = 1
+            case 'show':
+                languages = ['en', 'zh-TW'] if args.language == 'ALL' else [args.language]
+                for ref in _read_args(args.refs, args.file):
+                    try:
+                        for record in lookup_ref(ref, languages):
+                            _emit(out, {'ref': ref, **record})
+                    except (ValueError, KeyError) as e:
+                        _emit(out, {'ref': ref, 'error': f"Not in the bible: {e}"})
+                        status = 1
+            case 'audio':
+                for ref in _read_args(args.refs, args.file):
+                    try:
+                        passages = references.parse(ref)
+                    except ValueError as e:
+                        _emit(out, {'ref': ref, 'error': str(e)})
+                        status = 1
+                        continue
+                    #   chapters, as a whole, of each passage; Jude 3 is in Jude 1, as
+                    #       Jude has one chapter, see references.resolve
+                    for book, chapter, verse, endChapter, _ in passages:
+                        if verse is None and chapter and bookIndex(args.language).chapsInBook[book] == 1:
+                            chapter = endChapter = 1
+                        if chapter and not 1 <= chapter <= endChapter <= bookIndex(args.language).chapsInBook[book]:
+                            _emit(out, {'ref': ref, 'error': f"No chapter {endChapter} in {book}"})
+                            status = 1
+                            continue
+                        elif chapter:
+                            summary = audio_chapters(book, range(chapter, endChapter + 1), args.language, args.engine)
+                        else:
+                            summary = audio_book(book, args.language, args.engine)
+                        if summary is None:
+                            _emit(out, {'ref': ref, 'error': f"No TTS engine {args.engine}"})
+                            status = 1
+                            break
+                        for fileName in summary.generated:
+                            _emit(out, {'ref': ref, 'file': fileName, 'status': 'generated'})
+                        for fileName in summary.cached:
+                            _emit(out, {'ref': ref, 'file': fileName, 'status': 'cached'})
+                        for fileName, error in summary.failed:
+                            _emit(out, {'ref': ref, 'file': fileName, 'status': 'failed', 'error': str(error)})
+                            status = 1
+            case 'index':
+                language = args.language
+                index_bible()
+                _emit(out, {'index': f"indexdir_{language}", 'language': language})
+            case 'serve':
+                serve(args.host, args.port)
+    out.flush()
+    return status
+
 # -----------------------------------------------------------------------------
 #
 # prepare all globals
@@ -872,42 +1660,94 @@ _configfile = "./config.ini"
 _cfg = Config(_configfile)
 #   default audio/search language
 language = _cfg.get_config('MAIN', 'language')
-#   pickle files for english and chinese bibles
+#   text files for english and chinese bibles, pickle or binary corpus
 englishText = _cfg.get_config('TEXT', 'english')
 chineseText = _cfg.get_config('TEXT', 'chinese')
+#   verses of english and chinese bibles paired, built from the text files
+alignmentFile = _cfg.get_config('TEXT', 'alignment', 'alignment.json')
+#   log of verse corrections, replayed on top of the text files
+journal = Journal(_cfg.get_config('TEXT', 'corrections', 'corrections.jsonl'))
 #   default TTS engine
 engine = _cfg.get_config('TTS', 'engine')
 #   default player
 player = _cfg.get_config('TTS', 'player')
+#   no. of files synthesized at the same time, and retries of each
+maxConcurrency = int(_cfg.get_config('TTS', 'max_concurrency', '4'))
+ttsRetries = int(_cfg.get_config('TTS', 'retries', '3'))
+#   no. of chapters synthesized ahead while one is played, 0 for none
+prefetchChapters = int(_cfg.get_config('TTS', 'prefetch', '2'))
+#   play chapter audio while it is synthesized, ie piped to player
+streamAudio = _cfg.get_config('TTS', 'stream', 'no').lower() in ('yes', 'true', 'on', '1')
+#   audio files, and the budget of verse audio in ./audio/tmp
+#       segments of chapter audio are kept too, outside the budget, if keep_segments,
+#       so a corrected verse costs one segment, at about twice the disk space
+audioCache = AudioCache('./audio', int(_cfg.get_config('TTS', 'tmp_cache_mb', '200')) * 2**20,
+                        _cfg.get_config('TTS', 'keep_segments', 'no').lower() in ('yes', 'true', 'on', '1'))
 #   others
 numberPerPage = int(_cfg.get_config('OTHERS', 'numberperpage'))
-#   list all config
-_cfg.list_config()
-
-_englishPkl = open(englishText, 'rb')
-_chinesePkl = open(chineseText, 'rb')
-bible = pickle.load(_englishPkl, encoding='utf-8')
-cbible = pickle.load(_chinesePkl, encoding='utf-8')
-
 #
-# i am lazy, so let the computer construct some global variables
+#   bibles and the book lists are loaded/constructed on first use, see
+#       selectBible() and bookIndex()
 #
-OTbooks = []            # books in OT
-NTbooks = []            # books in NT
-ALLbooks = []           # all books in bible
-chapsInBook = {}        # no. of chapters in each book
-
-_count = 0
-for book in bible.keys():
-    chapsInBook[book] = len(bible[book])
-    ALLbooks.append(book)
-    _count = _count + 1
-    if _count <= 39:    # 39 is the only variable i need to remember: # books in OT
-        OTbooks.append(book)
-    else:
-        NTbooks.append(book)
+BookIndex = namedtuple('BookIndex', 'OTbooks NTbooks ALLbooks chapsInBook')
+_bibles = {}            # bible text of each language
+_bookIndex = None       # BookIndex, ie the globals constructed from the bible
+_alignment = None       # Alignment of en-bible and zh-bible
+_searchEngines = {}     # keyword search engine of each language
+#   results of keyword and indexed search, by (language, scope, query, mode)
+searchCache = LRUCache(int(_cfg.get_config('SEARCH', 'cache_entries', '256')))
+_indexVersions = {}     # IndexManager.version() of each language, of cached indexed search results
+#   processes to scan for a regular expression in, 1 for none (this process),
+#       0 for one per cpu, and the least no. of verses worth sending to them
+searchProcs = int(_cfg.get_config('SEARCH', 'procs', '1'))
+searchMinVerses = int(_cfg.get_config('SEARCH', 'min_verses', '2000'))
+indexManager = IndexManager()   # whoosh index of each language, opened on first use
+#   seconds to wait for the lock of an index to update verses in it, and the
+#       lock of indexdir_{language}/stale, see reindex_verse()
+indexLockTimeout = float(_cfg.get_config('INDEX', 'lock_timeout', '2'))
+_staleLock = threading.Lock()
+#
+#   timers and counters of hot functions, off unless [TRACE] mode or
+#       PYBIBLE_TRACE says otherwise, see tracing.py
+#
+tracer = tracing.start(os.environ.get('PYBIBLE_TRACE') or _cfg.get_config('TRACE', 'mode', 'off'),
+                       _cfg.get_config('TRACE', 'profile', 'pybible.prof'))
+if tracer:
+    import tts
+    #   counted: verses loaded or found, hits, or files generated
+    tracer.instrument(sys.modules[__name__], {
+        'load_corpus': lambda store: store.count(),
+        'selectBible': None,
+        'searchEngine': None,
+        'search_key': lambda result: len(result[2]),
+        'search_booklist': lambda result: sum(len(verses) for _, _, verses in result),
+        'search_many': len,
+        'isearch': len,
+        'isearch_book': None,
+        'iCsearch_book': None,
+        'index_bible': None,
+        'reindex_verse': None,
+        'audio_chapters': lambda summary: len(summary.generated) if summary else 0,
+        'text2Audio': None,
+        'playAudioFile': None,
+    })
+    tracer.instrument(IndexManager, {'searcher': None}, 'IndexManager.')
+    tracer.instrument(tts, {'synthesize': None, 'start_player': None}, 'tts.')
+
+def __getattr__(name):
+    """ lazily initialized module globals, eg bible.cbible or bible.ALLbooks
+    """
+    if name == 'bible':
+        return selectBible('en')
+    if name == 'cbible':
+        return selectBible('zh-TW')
+    if name in BookIndex._fields:
+        return getattr(bookIndex(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:       # batch use, see cli()
+        sys.exit(cli())
     main()
 
 
@@ -0,0 +1,66 @@
+"""
+Many key words found in one pass over the texts, ie an Aho-Corasick automaton.
+
+The key words are put in a trie, each node of which is a state; a state
+also has a fail link, to the state of the longest proper suffix of its
+text which is in the trie as well.  Texts are read one character at a
+time, following the trie and, when there is no way on, fail links, so
+every occurrence of every key word is found in a single pass, however
+many key words there are, eg the few thousand terms of a concordance.
+"""
+
+from collections import Counter
+
+
+class Automaton:
+    """ Aho-Corasick automaton of (plain text) key words
+    """
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.goto = [{}]            # state -> {character: next state}, 0 is the root
+        self.out = [[]]             # state -> key words (by no.) ending there
+        for n, keyword in enumerate(self.keywords):
+            state = 0
+            for c in keyword:
+                nextState = self.goto[state].get(c)
+                if nextState is None:
+                    nextState = len(self.goto)
+                    self.goto[state][c] = nextState
+                    self.goto.append({})
+                    self.out.append([])
+                state = nextState
+            self.out[state].append(n)
+        #   fail links, breadth first, so those of shorter texts are known first
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, nextState in self.goto[state].items():
+                if state:
+                    f = self.fail[state]
+                    while f and c not in self.goto[f]:
+                        f = self.fail[f]
+                    self.fail[nextState] = self.goto[f].get(c, 0)
+                    self.out[nextState] = self.out[nextState] + self.out[self.fail[nextState]]
+                queue.append(nextState)
+
+    def scan(self, texts, first, last):
+        """ occurrences of each key word in texts[first:last]
+
+        return [{index into texts: no. of occurrences}*], by key word
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        found = [{} for _ in self.keywords]
+        for i in range(first, last):
+            state = 0
+            ends = []           # states where key words end, counted once the text is read
+            for c in texts[i]:
+                while state and c not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(c, 0)
+                if out[state]:
+                    ends.append(state)
+            if ends:
+                for state, count in Counter(ends).items():
+                    for n in out[state]:
+                        found[n][i] = found[n].get(i, 0) + count
+        return found
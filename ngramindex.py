@@ -0,0 +1,74 @@
+"""
+Character bigram inverted index, for exact phrase search with no analyzer.
+
+Every two adjacent characters of a text, eg 義人 and 人必 of 義人必因信得生,
+are a bigram, and the index holds, for each bigram, the sorted indices of
+texts it is in, ie its posting list.  Posting lists are slices of a single
+array of unsigned ints, so the whole CUV is some 4 bytes per bigram of each
+verse, instead of a python list (and int objects) per bigram.
+
+A phrase can only be in texts that have all its bigrams, so its candidates
+are the intersection of their posting lists, shortest first, and then each
+candidate is checked for the phrase itself.  Unlike jieba (and so indexed
+search), nothing depends on how the phrase is segmented into words.
+"""
+
+from array import array
+from bisect import bisect_left
+
+
+class BigramIndex:
+    """ bigram -> posting list, over a list of texts
+    """
+    def __init__(self, texts):
+        self.texts = texts
+        lists = {}
+        for i, text in enumerate(texts):
+            for gram in {text[j:j+2] for j in range(len(text) - 1)}:
+                postings = lists.get(gram)
+                if postings is None:
+                    lists[gram] = postings = []
+                postings.append(i)
+        self.postings = array('I')          # posting lists, one after another
+        self.spans = {}                     # bigram -> (start, end) in postings
+        for gram, postings in lists.items():
+            start = len(self.postings)
+            self.postings.extend(postings)
+            self.spans[gram] = (start, len(self.postings))
+
+    def candidates(self, phrase, first=0, last=None):
+        """ indices in texts[first:last] having all bigrams of phrase (at least 2 characters)
+        """
+        if last is None:
+            last = len(self.texts)
+        postings = self.postings
+        spans = []
+        for gram in {phrase[j:j+2] for j in range(len(phrase) - 1)}:
+            span = self.spans.get(gram)
+            if span is None:
+                return []
+            lo = bisect_left(postings, first, *span)
+            hi = bisect_left(postings, last, lo, span[1])
+            if lo == hi:
+                return []
+            spans.append([lo, hi])
+        spans.sort(key=lambda span: span[1] - span[0])
+        (lo, hi), rest = spans[0], spans[1:]
+        result = []
+        for i in postings[lo:hi]:
+            for span in rest:
+                #   candidates are ascending, so each posting list is searched
+                #       from where the last candidate was found on
+                k = bisect_left(postings, i, *span)
+                span[0] = k
+                if k == span[1] or postings[k] != i:
+                    break
+            else:
+                result.append(i)
+        return result
+
+    def search(self, phrase, first=0, last=None):
+        """ indices in texts[first:last] which contain phrase (at least 2 characters)
+        """
+        texts = self.texts
+        return [i for i in self.candidates(phrase, first, last) if phrase in texts[i]]
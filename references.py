@@ -0,0 +1,206 @@
+"""
+Scripture references, eg "John 3:16-18; Rom 8; Ps 23:1-3, 5" or "約 3:16；羅 8".
+
+A reference is a list of passages separated by ';', each of which is
+
+    book                            whole book, eg Jude
+    book chapter[-chapter]          whole chapters, eg Rom 8, Ps 120-134
+    book chapter:verse[-verse]      verses, eg John 3:16-18
+    book chapter:verse-chapter:verse
+                                    across chapters, eg John 3:16-4:2
+
+and may go on after ',' with more verses, eg Ps 23:1-3, 5, or chapters,
+eg Ps 23:1-3, 24:1, of the same book.  A passage after ';' without a book
+is of the book before it, eg John 3:16; 4:1.
+
+Books are canonical names, as in the text files, English abbreviations, or
+Chinese names, full or short, as in CUV, eg 約翰福音 or 約; case, spaces and
+dots do not matter, nor do full-width ；，：, and any unique beginning of a
+canonical name will do, eg Genes.
+
+resolve() maps a passage to a range of verse ids of a VerseStore, whose
+verses are then read as a single slice of its buffer, see lookup_refs() in
+bible.py.
+"""
+
+import re
+from bisect import bisect_left
+from collections import namedtuple
+
+#   canonical name, English abbreviations, Chinese names (full, short, ...)
+BOOKS = [
+    ('Genesis', 'Gen Ge Gn', '創世記 創'),
+    ('Exodus', 'Exod Exo Ex', '出埃及記 出'),
+    ('Leviticus', 'Lev Le Lv', '利未記 利'),
+    ('Numbers', 'Num Nu Nm Nb', '民數記 民'),
+    ('Deuteronomy', 'Deut Deu Dt De', '申命記 申'),
+    ('Joshua', 'Josh Jos Jsh', '約書亞記 書'),
+    ('Judges', 'Judg Jdg Jg Jdgs', '士師記 士'),
+    ('Ruth', 'Rth Ru', '路得記 得'),
+    ('1 Samuel', '1Sam 1Sa 1Sm 1S', '撒母耳記上 撒上'),
+    ('2 Samuel', '2Sam 2Sa 2Sm 2S', '撒母耳記下 撒下'),
+    ('1 Kings', '1Kgs 1Ki 1Kin 1K', '列王紀上 列王記上 王上'),
+    ('2 Kings', '2Kgs 2Ki 2Kin 2K', '列王紀下 列王記下 王下'),
+    ('1 Chronicles', '1Chr 1Ch 1Chron', '歷代志上 代上'),
+    ('2 Chronicles', '2Chr 2Ch 2Chron', '歷代志下 代下'),
+    ('Ezra', 'Ezr Ez', '以斯拉記 拉'),
+    ('Nehemiah', 'Neh Ne', '尼希米記 尼'),
+    ('Esther', 'Esth Est Es', '以斯帖記 斯'),
+    ('Job', 'Jb', '約伯記 伯'),
+    ('Psalms', 'Ps Psa Psalm Pss Psm', '詩篇 詩'),
+    ('Proverbs', 'Prov Pro Prv Pr', '箴言 箴'),
+    ('Ecclesiastes', 'Eccl Ecc Ec Qoh', '傳道書 傳'),
+    ('Song of Solomon', 'Song Songs SOS SS Canticles', '雅歌 歌'),
+    ('Isaiah', 'Isa Is', '以賽亞書 賽'),
+    ('Jeremiah', 'Jer Je Jr', '耶利米書 耶'),
+    ('Lamentations', 'Lam La', '耶利米哀歌 哀'),
+    ('Ezekiel', 'Ezek Eze Ezk', '以西結書 結'),
+    ('Daniel', 'Dan Da Dn', '但以理書 但'),
+    ('Hosea', 'Hos Ho', '何西阿書 何'),
+    ('Joel', 'Jl', '約珥書 珥'),
+    ('Amos', 'Am', '阿摩司書 摩'),
+    ('Obadiah', 'Obad Ob', '俄巴底亞書 俄'),
+    ('Jonah', 'Jon Jnh', '約拿書 拿'),
+    ('Micah', 'Mic Mc', '彌迦書 彌'),
+    ('Nahum', 'Nah Na', '那鴻書 鴻'),
+    ('Habakkuk', 'Hab Hb', '哈巴谷書 哈'),
+    ('Zephaniah', 'Zeph Zep Zp', '西番雅書 番'),
+    ('Haggai', 'Hag Hg', '哈該書 該'),
+    ('Zechariah', 'Zech Zec Zc', '撒迦利亞書 亞'),
+    ('Malachi', 'Mal Ml', '瑪拉基書 瑪'),
+    ('Matthew', 'Matt Mat Mt', '馬太福音 太'),
+    ('Mark', 'Mrk Mk Mr', '馬可福音 可'),
+    ('Luke', 'Luk Lk', '路加福音 路'),
+    ('John', 'Jhn Jn', '約翰福音 約'),
+    ('Acts', 'Act Ac', '使徒行傳 徒'),
+    ('Romans', 'Rom Ro Rm', '羅馬書 羅'),
+    ('1 Corinthians', '1Cor 1Co', '哥林多前書 林前'),
+    ('2 Corinthians', '2Cor 2Co', '哥林多後書 林後'),
+    ('Galatians', 'Gal Ga', '加拉太書 加'),
+    ('Ephesians', 'Eph Ephes', '以弗所書 弗'),
+    ('Philippians', 'Phil Php Pp', '腓立比書 腓'),
+    ('Colossians', 'Col Co', '歌羅西書 西'),
+    ('1 Thessalonians', '1Thess 1Thes 1Th', '帖撒羅尼迦前書 帖前'),
+    ('2 Thessalonians', '2Thess 2Thes 2Th', '帖撒羅尼迦後書 帖後'),
+    ('1 Timothy', '1Tim 1Ti', '提摩太前書 提前'),
+    ('2 Timothy', '2Tim 2Ti', '提摩太後書 提後'),
+    ('Titus', 'Tit Ti', '提多書 多'),
+    ('Philemon', 'Philem Phlm Phm', '腓利門書 門'),
+    ('Hebrews', 'Heb', '希伯來書 來'),
+    ('James', 'Jas Jm', '雅各書 雅'),
+    ('1 Peter', '1Pet 1Pe 1Pt 1P', '彼得前書 彼前'),
+    ('2 Peter', '2Pet 2Pe 2Pt 2P', '彼得後書 彼後'),
+    ('1 John', '1Jn 1Jhn 1Jo', '約翰一書 約壹 約一'),
+    ('2 John', '2Jn 2Jhn 2Jo', '約翰二書 約貳 約二'),
+    ('3 John', '3Jn 3Jhn 3Jo', '約翰三書 約參 約三'),
+    ('Jude', 'Jud Jd', '猶大書 猶'),
+    ('Revelation', 'Rev Re Rv Revelations Apocalypse', '啟示錄 啓示錄 啟'),
+]
+
+#   a passage: chapter is None for a whole book, verse None from the start of
+#       chapter, endVerse None to the end of endChapter
+Passage = namedtuple('Passage', 'book chapter verse endChapter endVerse')
+
+_ORDINALS = {'i': '1', 'ii': '2', 'iii': '3', 'first': '1', 'second': '2', 'third': '3',
+             '1st': '1', '2nd': '2', '3rd': '3'}
+_FULLWIDTH = str.maketrans({'；': ';', '，': ',', '：': ':', '－': '-', '–': '-', '—': '-', '、': ','})
+#   book, then what follows it, ie chapters and verses
+_PASSAGE = re.compile(r"\s*(?P<book>\d?\s*[^\d\s:,;.-][^\d:,;]*?)?\.?\s*(?P<rest>\d[\d\s:,.-]*)?\s*")
+_CHAPTER_VERSE = re.compile(r"(\d+)(?:[:.](\d+))?(?:-(\d+)(?:[:.](\d+))?)?")
+
+
+def _key(name):
+    """ name as looked up, ie lowercased, without spaces and dots, ordinals as digits
+    """
+    words = name.lower().replace('.', ' ').split()
+    if len(words) > 1 and words[0] in _ORDINALS:
+        words[0] = _ORDINALS[words[0]]
+    return ''.join(words)
+
+_NAMES = {}
+for _book, _english, _chinese in BOOKS:
+    for _name in [_book] + _english.split() + _chinese.split():
+        _NAMES.setdefault(_key(_name), _book)
+
+def book_name(name):
+    """ canonical name of a book, by name, abbreviation or unique beginning
+
+    raise ValueError if there is no such book, or more than one
+    """
+    key = _key(name)
+    if key in _NAMES:
+        return _NAMES[key]
+    found = {book for book, _, _ in BOOKS if _key(book).startswith(key)} if key else set()
+    if len(found) != 1:
+        raise ValueError(f"No book {name!r}" if not found else f"Book {name!r} is one of {sorted(found)}")
+    return found.pop()
+
+def parse(text):
+    """ passages of a reference, see above
+
+    raise ValueError if text is not a reference
+    """
+    passages = []
+    book = None
+    for part in text.translate(_FULLWIDTH).split(';'):
+        if not part.strip():
+            continue
+        m = _PASSAGE.fullmatch(part)
+        if not m or not (m.group('book') or m.group('rest')):
+            raise ValueError(f"Not a reference: {part.strip()!r}")
+        if m.group('book'):
+            book = book_name(m.group('book'))
+        elif book is None:
+            raise ValueError(f"No book in reference: {part.strip()!r}")
+        if not m.group('rest'):
+            passages.append(Passage(book, None, None, None, None))
+            continue
+        chapter = None          # chapter of verses after ','
+        for piece in m.group('rest').replace(' ', '').split(','):
+            if not piece:
+                continue
+            cv = _CHAPTER_VERSE.fullmatch(piece)
+            if not cv:
+                raise ValueError(f"Not a reference: {part.strip()!r}")
+            a, b, c, d = (int(x) if x else None for x in cv.groups())
+            if b is not None:                       # chapter:verse[-verse | -chapter:verse]
+                chapter = a
+                if d is not None:
+                    passages.append(Passage(book, a, b, c, d))
+                else:
+                    passages.append(Passage(book, a, b, a, c if c is not None else b))
+            elif chapter is not None and d is None:     # verse[-verse] of the chapter before
+                passages.append(Passage(book, chapter, a, chapter, c if c is not None else a))
+            elif d is None:                         # chapter[-chapter]
+                passages.append(Passage(book, a, None, c if c is not None else a, None))
+            else:                                   # chapter-chapter:verse
+                chapter = c
+                passages.append(Passage(book, a, None, c, d))
+    if not passages:
+        raise ValueError(f"Not a reference: {text!r}")
+    return passages
+
+def resolve(store, passage):
+    """ (first, last) verse ids of passage in store, a VerseStore, last excluded
+
+    verses a version lacks are left out, eg John 7:50-53 is 4 verses in KJV
+        and 3 in CUV; Jude 3 is Jude 1:3, as Jude has one chapter
+    raise KeyError if a chapter is not in the book, or passage is backwards
+    """
+    if passage.chapter is None:
+        return store.book_range(passage.book)
+    if passage.verse is None and passage.endChapter > 1 and len(store[passage.book]) == 1:
+        #   verses of a book of one chapter, eg Jude 3 or 3 John 13-14
+        passage = Passage(passage.book, 1, passage.chapter, 1, passage.endChapter)
+    try:
+        first, last = store.chapter_range(passage.book, passage.chapter)
+        endFirst, endLast = store.chapter_range(passage.book, passage.endChapter)
+    except KeyError as e:
+        raise KeyError(f"No chapter {e.args[0]} in {passage.book}") from None
+    if passage.verse is not None:
+        first = bisect_left(store.verseNos, passage.verse, first, last)
+    if passage.endVerse is not None:
+        endLast = bisect_left(store.verseNos, passage.endVerse + 1, endFirst, endLast)
+    if endLast < first or passage.endChapter < passage.chapter:
+        raise KeyError(f"{passage.book} {passage.chapter} .. {passage.endChapter}")
+    return first, endLast
@@ -0,0 +1,68 @@
+"""
+Bounded cache of results, least recently used out first.
+
+Used for search results, keyed by (language, scope, normalized query, mode),
+and for encoded responses of server.py.  What a key was computed from may
+change, eg a verse is corrected or an index rebuilt, so entries can be
+dropped by a test on their keys, see discard().
+
+Cached values are shared by all who get them, and are not to be modified.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ {key: value} of at most max_entries, with hit/miss counters
+    """
+    def __init__(self, max_entries=256):
+        self.maxEntries = max_entries       # 0 for no cache
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ cached value of key, None if there is none
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.maxEntries:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def discard(self, test):
+        """ drop entries of which test(key) is true, return no. of them
+        """
+        with self._lock:
+            keys = [key for key in self._entries if test(key)]
+            for key in keys:
+                del self._entries[key]
+            self.invalidated += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.invalidated += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries), 'max_entries': self.maxEntries,
+                    'hits': self.hits, 'misses': self.misses, 'invalidated': self.invalidated,
+                    'hit_rate': round(self.hits / lookups, 3) if lookups else None}
@@ -0,0 +1,271 @@
+"""
+Keyword search engine over a whole bible version.
+
+The engine holds one version of the bible, a VerseStore (see versestore.py),
+lowercased into a single buffer of characters of the same width, ie
+latin-1, utf-16 or utf-32, verses separated by '\0', with the offset in it
+where each verse starts.  An index into texts is a verse id of the store,
+so (book, chapter, verse) is read from the store.  It is built once per
+version, so a search compiles its pattern once and scans plain strings only.
+
+A key word with no regular expression in it, ie plain text, is not scanned
+for verse by verse:
+    1. it may be looked up in a bigram index, see ngramindex.py, or else
+    2. with numpy, it is found all at once in the buffer, seen as one array
+       of characters, and each place found is mapped back to its verse by
+       searchsorted() over where the verses start.
+The packed version, ie arrays over the buffer, is built on first use.  The bigram index takes about a
+second to build, and more memory, so it is used only once it is built by
+phrase_index(), eg by bible.serve() before serving, not by the first
+phrase searched for in a one-off run.  Many plain text key words are found all in
+one pass, see search_many() and concordance.py.  A regular expression may
+be scanned for in worker processes, a shard of the verses each, if the
+engine is given a SearchPool, see searchpool.py.
+
+Results are in the same format as bible.search_key()/search_booklist():
+    [ [book, chapter, [list of verses]]* ]
+"""
+
+import codecs, importlib.util, re, threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from itertools import accumulate
+
+from concordance import Automaton
+from ngramindex import BigramIndex
+
+#   numpy is imported on first use of packed(), not with the engine, as it
+#       takes longer to import than the rest of pybible; without numpy, plain
+#       text is scanned for as any other key word
+_HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+#   bytes a character -> encoding of the buffer, and its decoder (the codecs
+#       function itself, faster than bytes.decode() for a short slice)
+_ENCODINGS = {1: ('latin-1', codecs.latin_1_decode),
+              2: ('utf-16-le', codecs.utf_16_le_decode),
+              4: ('utf-32-le', codecs.utf_32_le_decode)}
+
+#   characters with a special meaning in a regular expression, and the
+#       separator of verses in the packed version
+_SPECIAL = re.compile(r"[.^$*+?{}\[\]\\|()\0]")
+
+
+class _Texts(Sequence):
+    """ lowercased text of each verse id, read from the buffer of an engine
+    """
+    __slots__ = ('_engine', '_buffer', '_starts', '_width', '_decode')
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._buffer, self._starts, self._width = engine.buffer, engine.starts, engine.width
+        self._decode = _ENCODINGS[engine.width][1]
+
+    def __getitem__(self, i):
+        width = self._width
+        return self._decode(self._buffer[self._starts[i]*width:(self._starts[i+1]-1)*width])[0]
+
+    def __len__(self):
+        return len(self._starts) - 1
+
+    def __iter__(self):
+        return iter(self._engine.decode(0, len(self)))
+
+
+class SearchEngine:
+    """ Keyword search on a lowercased bible version
+    """
+
+    def __init__(self, store, ngram=False, pool=None):
+        self.store = store          # VerseStore of the version
+        texts = [text.lower() for text in store.texts(0, store.count())]
+        text = '\0'.join(texts)
+        #   as few bytes a character as will do, eg 1 for English, 2 for Chinese
+        widest = max(text, default='\0')
+        self.width = 1 if widest <= '\xff' else 2 if widest <= '\uffff' else 4
+        self.buffer = text.encode(_ENCODINGS[self.width][0])
+        #   starts[i] is where verse id i starts in buffer, in characters, and
+        #       starts[-1] its length + 1, as if it ended with a separator
+        self.starts = array('q', accumulate((len(t) + 1 for t in texts), initial=0))
+        del texts, text
+        self.texts = _Texts(self)   # lowercased verse text, by verse id
+        self.bookRange = {book: store.book_range(book) for book in store}
+        self.ngram = ngram          # search phrases in a BigramIndex, eg for Chinese
+        self.pool = pool            # SearchPool to scan large ranges for a regular expression
+        self._phraseIndex = None
+        self._packed = None
+        self._lock = threading.Lock()
+
+    def phrase_index(self):
+        """ BigramIndex of texts, built on first call
+        """
+        with self._lock:
+            if self._phraseIndex is None:
+                self._phraseIndex = BigramIndex(self.texts)
+            return self._phraseIndex
+
+    def decode(self, first, last):
+        """ lowercased text of verse ids first .. last-1, decoded as one slice of buffer
+        """
+        if first >= last:
+            return []
+        width, starts = self.width, self.starts
+        return _ENCODINGS[width][1](self.buffer[starts[first]*width:(starts[last]-1)*width])[0].split('\0')
+
+    def packed(self):
+        """ (characters, starts, counts): buffer as a numpy array of code points,
+                starts as a numpy array, neither copied, and the no. of times
+                each code point is in buffer
+        """
+        import numpy
+        with self._lock:
+            if self._packed is None:
+                chars = numpy.frombuffer(self.buffer, dtype={1: numpy.uint8, 2: numpy.uint16, 4: numpy.uint32}[self.width])
+                starts = numpy.frombuffer(self.starts, dtype=numpy.int64)
+                self._packed = chars, starts, numpy.bincount(chars)
+            return self._packed
+
+    def find(self, text, first, last):
+        """ indices in texts[first:last] which contain (lowercased) text, found
+                in the packed version, see packed()
+        """
+        import numpy
+        chars, starts, counts = self.packed()
+        if first >= last:
+            return []
+        begin = starts[first]
+        end = starts[last] - 1
+        codes = [ord(c) for c in text]
+        if any(code >= len(counts) or not counts[code] for code in codes) or len(codes) > end - begin:
+            return []
+        #   places of the (up to 3) rarest characters, compared a whole window
+        #       at a time, then narrowed down by each other character
+        rarest = sorted(range(len(codes)), key=lambda k: counts[codes[k]])
+        size = end - begin - len(codes) + 1
+        mask = None
+        for k in rarest[:3]:
+            match = chars[begin + k:begin + k + size] == codes[k]
+            mask = match if mask is None else numpy.logical_and(mask, match, out=mask)
+        found = numpy.flatnonzero(mask) + begin
+        for k in rarest[3:]:
+            found = found[chars[found + k] == codes[k]]
+        #   found is ascending, and so are the verses it maps to
+        verses = numpy.searchsorted(starts, found, side='right') - 1
+        if len(verses):
+            verses = verses[numpy.concatenate(([True], verses[1:] != verses[:-1]))]
+        return verses.tolist()
+
+    def is_plain(self, kw):
+        """ True if kw is plain text, ie the same as a regular expression
+        """
+        return bool(kw) and not _SPECIAL.search(kw)
+
+    def phrase_indexed(self, kw):
+        """ True if kw is a phrase, see is_phrase(), to look up in the bigram
+                index, and the index is built already
+        """
+        return self.ngram and self._phraseIndex is not None and self.is_phrase(kw)
+
+    def is_phrase(self, kw):
+        """ True if kw is plain text of 2 characters or more
+        """
+        return len(kw) >= 2 and self.is_plain(kw)
+
+    def indices(self, kw, first, last):
+        """ indices in texts[first:last] matched by key word (kw), by whichever
+                of bigram index, numpy or scan fits kw, ie
+                phrase_indexed(), is_plain() or any regular expression
+        """
+        if self.phrase_indexed(kw):
+            return self._phraseIndex.search(kw.lower(), first, last)
+        if _HAS_NUMPY and self.is_plain(kw):
+            return self.find(kw.lower(), first, last)
+        return self.scan_ranges(kw, [(first, last)])[0]
+
+    def compile(self, kw):
+        """ compile key word (kw) the way search_key() always did: lowercased
+        """
+        return re.compile(kw.lower())
+
+    def scan(self, patc, first, last):
+        """ indices in texts[first:last] matched by the compiled pattern
+        """
+        return [i for i, text in enumerate(self.decode(first, last), first) if patc.search(text)]
+
+    def scan_ranges(self, kw, ranges):
+        """ indices matched by key word (kw) in each of ranges, ie [(first, last)*],
+                in the worker processes of pool if the ranges are large enough
+
+        return [[index*]*], by range
+        """
+        patc = self.compile(kw)     # a bad pattern is raised here, not in a worker
+        if self.pool is not None and sum(last - first for first, last in ranges) >= self.pool.minVerses:
+            found = self.pool.scan(kw, ranges)
+            if found is not None:   # else a worker died, eg out of memory, scan here instead
+                return found
+        return [self.scan(patc, first, last) for first, last in ranges]
+
+    def group(self, indices):
+        """ group (sorted) indices into [ [book, chapter, [list of verses]]* ]
+        """
+        result = []
+        store = self.store
+        books, bookStart, chapterStart, verseNos = store.books, store.bookStart, store.chapterStart, store.verseNos
+        indices = list(indices)
+        n = 0
+        while n < len(indices):
+            #   the run of indices in the chapter (index c) of indices[n]
+            c = bisect_right(chapterStart, indices[n]) - 1
+            b = bisect_right(bookStart, c) - 1
+            end = bisect_left(indices, chapterStart[c+1], n)
+            result.append([books[b], c - bookStart[b] + 1, [verseNos[i] for i in indices[n:end]]])
+            n = end
+        return result
+
+    def search_chapter(self, book, chapter, kw):
+        """ Keyword (kw) search on book/chapter
+
+        return [book, chapter, [list of verses]], verse list may be empty
+        """
+        first, last = self.store.chapter_range(book, chapter)
+        verseNos = self.store.verseNos
+        return [book, chapter, [verseNos[i] for i in self.indices(kw, first, last)]]
+
+    def search(self, bookList, kw):
+        """ Keyword (kw) search on bookList, chapters without a hit are left out
+
+        return list format: [ [book, chapter, [list of verses]]* ]
+        """
+        result = []
+        if self.is_plain(kw) and (_HAS_NUMPY or self.phrase_indexed(kw)):
+            #   one pass over all of bookList, then split by book
+            ranges = [self.bookRange[book] for book in bookList]
+            if not ranges:
+                return result
+            found = self.indices(kw, min(ranges)[0], max(ranges)[1])
+            for first, last in ranges:
+                result.extend(self.group(found[bisect_left(found, first):bisect_left(found, last)]))
+            return result
+        for indices in self.scan_ranges(kw, [self.bookRange[book] for book in bookList]):
+            result.extend(self.group(indices))
+        return result
+
+    def search_many(self, bookList, keywords):
+        """ Plain text key words searched for in one pass over bookList,
+                lowercased as in search()
+
+        return {kw: {index into texts: no. of occurrences}}, ascending by index
+        """
+        keywords = list(dict.fromkeys(keywords))
+        texts = [kw.lower() for kw in keywords]
+        if not all(texts):
+            raise ValueError("Empty key word")
+        distinct = list(dict.fromkeys(texts))
+        automaton = Automaton(distinct)
+        found = [{} for _ in distinct]
+        for book in bookList:
+            first, last = self.bookRange[book]
+            for n, hits in enumerate(automaton.scan(self.texts, first, last)):
+                found[n].update(hits)
+        byText = dict(zip(distinct, found))
+        return {kw: byText[text] for kw, text in zip(keywords, texts)}
@@ -0,0 +1,107 @@
+"""
+Regular expression search of a bible version sharded over processes.
+
+A key word which is a regular expression, unlike plain text, is scanned for
+verse by verse, on a single core; a heavy one, eg with alternations,
+lookarounds or wide .* spans, takes seconds over all books.  A SearchPool
+splits the verses to scan into shards, in a ProcessPoolExecutor:
+
+    1. each worker process loads the version once, when it starts, from its
+       text file (a binary corpus file is memory mapped, so its pages are
+       shared), with corrections of the journal replayed, so neither the
+       text nor the compiled pattern is pickled with a task,
+    2. a task is (key word, first, last), a slice of the flattened version,
+       and returns the indices of the verses matched,
+    3. shards are taken in order, and their results joined in the same
+       order, so a search gives exactly what a single process would, in
+       canonical book order.
+
+The pool is started on first use, and used only for ranges of at least
+minVerses verses, as a small search is done sooner than a shard is sent.
+"""
+
+import os, threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from searchengine import SearchEngine
+from versestore import Journal, load_corpus
+
+_engine = None          # SearchEngine of the version, in a worker process
+
+
+def _init(fileName, language, journalFile):
+    global _engine
+    store = load_corpus(fileName)
+    if journalFile:
+        Journal(journalFile).replay(store, language)
+    _engine = SearchEngine(store)
+
+def _scan(kw, first, last):
+    return _engine.scan(_engine.compile(kw), first, last)
+
+
+class SearchPool:
+    """ worker processes, each with a version loaded, to scan for a regular
+            expression in shards
+    """
+    def __init__(self, fileName, language, journalFile=None, procs=0, minVerses=2000):
+        self.fileName = os.path.abspath(fileName)
+        self.language = language
+        self.journalFile = os.path.abspath(journalFile) if journalFile else None
+        self.procs = procs or os.cpu_count()
+        self.minVerses = minVerses
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        """ ProcessPoolExecutor, started on first use
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.procs, initializer=_init,
+                                                     initargs=(self.fileName, self.language, self.journalFile))
+            return self._executor
+
+    def shards(self, ranges):
+        """ ranges, ie [(first, last)*], cut into shards of about the same
+                no. of verses, a few for each process
+
+        return [(no. of range, first, last)*], in order
+        """
+        total = sum(last - first for first, last in ranges)
+        size = max(1, -(-total // (self.procs * 4)))
+        result = []
+        for n, (first, last) in enumerate(ranges):
+            for start in range(first, last, size):
+                result.append((n, start, min(start + size, last)))
+        return result
+
+    def scan(self, kw, ranges):
+        """ indices matched by key word (kw), a regular expression, in each of
+                ranges, ie [(first, last)*] of the flattened version
+
+        return [[index*]*], by range, or None if a worker died, and the pool
+            is then shut down
+        """
+        shards = self.shards(ranges)
+        found = [[] for _ in ranges]
+        if not shards:
+            return found
+        try:
+            results = self.executor().map(_scan, *zip(*((kw, first, last) for _, first, last in shards)))
+            for (n, _, _), indices in zip(shards, results):
+                found[n].extend(indices)
+        except BrokenProcessPool:
+            self.shutdown()
+            return None
+        return found
+
+    def shutdown(self):
+        """ stop the worker processes, eg when the version is corrected; the
+                pool starts again on next use
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,208 @@
+"""
+Local HTTP/JSON service, on asyncio streams.
+
+A JSONServer answers GET requests with JSON, one handler per path:
+
+    1. handlers are plain (blocking) functions of the query parameters, run
+       on a pool of threads, at most max_concurrency of them at a time, so
+       whatever they keep loaded, eg bible texts and index searchers, stays
+       resident between requests,
+    2. responses are kept in an LRUCache, keyed by path and query,
+       except for paths that are not to be cached, eg a random verse, and
+       for paths given a version, by it too, eg of an index, so responses of
+       a path are dropped when its version changes,
+    3. /metrics reports requests, errors and latency by path, and the cache.
+
+A handler raises ValueError for a bad request (400), KeyError for what is
+not there (404), or HTTPError for any other status.
+"""
+
+import asyncio, json, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+from resultcache import LRUCache
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Metrics:
+    """ requests, errors and latency (seconds) by path
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.inFlight = 0
+        self._paths = {}
+
+    def record(self, path, status, elapsed):
+        m = self._paths.setdefault(path, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        m['requests'] += 1
+        if status >= 400:
+            m['errors'] += 1
+        m['seconds'] += elapsed
+        m['max_seconds'] = max(m['max_seconds'], elapsed)
+
+    def stats(self):
+        paths = {}
+        for path, m in sorted(self._paths.items()):
+            paths[path] = dict(m, mean_seconds=m['seconds'] / m['requests'])
+        return {'uptime': time.time() - self.started, 'in_flight': self.inFlight, 'paths': paths}
+
+
+class JSONServer:
+    """ GET path?query -> JSON, by handlers in routes, ie {path: handler(params)}
+    """
+    def __init__(self, routes, host='127.0.0.1', port=8000, max_concurrency=8, cache_entries=1024,
+                 uncached=(), metrics=None, idle_timeout=30, versions=None):
+        self.routes = dict(routes)
+        self.host = host
+        self.port = port
+        self.maxConcurrency = max_concurrency
+        self.uncached = set(uncached)
+        self.versions = dict(versions or {})    # path -> function returning the version of its responses
+        self._seenVersions = {}                 # path -> version of its cached responses
+        self.extraMetrics = metrics             # function returning more of /metrics, or None
+        self.idleTimeout = idle_timeout
+        self.cache = LRUCache(cache_entries)
+        self.metrics = Metrics()
+        self._executor = None
+        self._slots = None
+
+    def metrics_report(self):
+        report = self.metrics.stats()
+        report['cache'] = self.cache.stats()
+        if self.extraMetrics:
+            report.update(self.extraMetrics())
+        return report
+
+    async def respond(self, path, params):
+        """ (status, body, cache state) of a request
+        """
+        if path == '/metrics':
+            return 200, _encode(self.metrics_report()), None
+        handler = self.routes.get(path)
+        if handler is None:
+            return 404, _encode({'error': f"No such path: {path}"}), None
+        cacheable = path not in self.uncached
+        key = (path, tuple(sorted(params.items())))
+        if cacheable and path in self.versions:
+            version = self.versions[path]()
+            if self._seenVersions.get(path, version) != version:
+                self.cache.discard(lambda key: key[0] == path)
+            self._seenVersions[path] = version
+            key += (version,)
+        if cacheable:
+            body = self.cache.get(key)
+            if body is not None:
+                return 200, body, 'hit'
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(self._executor, handler, params)
+            except HTTPError as e:
+                return e.status, _encode({'error': str(e)}), None
+            except ValueError as e:
+                return 400, _encode({'error': str(e)}), None
+            except KeyError as e:
+                return 404, _encode({'error': f"Not found: {e}"}), None
+            except Exception as e:
+                print(f"--- {path} {params}: {e!r}", file=sys.stderr)
+                return 500, _encode({'error': 'Internal error'}), None
+        body = _encode(result)
+        if cacheable:
+            self.cache.put(key, body)
+        return 200, body, 'miss' if cacheable else None
+
+    async def handle(self, reader, writer):
+        """ requests of one connection, kept alive until either side closes it
+        """
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idleTimeout)
+                except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+                    break
+                if not line.strip():
+                    break
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if not header.strip():
+                        break
+                    name, _, value = header.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                #   -1 if it is not a no. of bytes, eg abc or -5, and then where the
+                #       next request starts is unknown, so the connection is closed
+                length = headers.get('content-length', '') or '0'
+                length = int(length) if length.isascii() and length.isdigit() else -1
+                if length > 0:
+                    await reader.readexactly(length)
+
+                started = time.perf_counter()
+                parts = line.decode('latin-1').split()
+                keepAlive = len(parts) == 3 and parts[2] == 'HTTP/1.1'
+                if headers.get('connection', '').lower() == 'close':
+                    keepAlive = False
+                elif headers.get('connection', '').lower() == 'keep-alive':
+                    keepAlive = True
+                cacheState = None
+                if len(parts) != 3:
+                    path, status, body = '-', 400, _encode({'error': 'Bad request line'})
+                elif length < 0:
+                    path, status, body = '-', 400, _encode({'error': f"Bad Content-Length: {headers['content-length']}"})
+                    keepAlive = False
+                elif parts[0] not in ('GET', 'HEAD'):
+                    path, status, body = '-', 405, _encode({'error': f"Method not allowed: {parts[0]}"})
+                else:
+                    url = urlsplit(parts[1])
+                    path = url.path.rstrip('/') or '/'
+                    self.metrics.inFlight += 1
+                    try:
+                        status, body, cacheState = await self.respond(path, dict(parse_qsl(url.query)))
+                    finally:
+                        self.metrics.inFlight -= 1
+                head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+                        "Content-Type: application/json; charset=utf-8",
+                        f"Content-Length: {len(body)}",
+                        f"Connection: {'keep-alive' if keepAlive else 'close'}"]
+                if cacheState:
+                    head.append(f"X-Cache: {cacheState}")
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+                if parts[0] != 'HEAD':
+                    writer.write(body)
+                await writer.drain()
+                self.metrics.record(path if path in self.routes or path == '/metrics' else '-',
+                                    status, time.perf_counter() - started)
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        self._executor = ThreadPoolExecutor(self.maxConcurrency, thread_name_prefix='handler')
+        self._slots = asyncio.Semaphore(self.maxConcurrency)
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+            async with server:
+                print(f"--- Serving http://{self.host}:{self.port}/ with {', '.join(sorted(self.routes))}, /metrics",
+                      file=sys.stderr)
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+
+
+def _encode(obj):
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
@@ -0,0 +1,120 @@
+"""
+Timers and counters around hot functions, and cProfile, for one run.
+
+Off by default; [TRACE] mode of config.ini, or the environment variable
+PYBIBLE_TRACE (which wins), turns it on:
+
+    off         nothing is wrapped or profiled, nor cProfile even imported,
+                so there is no cost at all
+    summary     calls, time and counts of each instrumented function, printed
+                to stderr at exit
+    profile     cProfile of the run (main thread only), written at exit to
+                [TRACE] profile, eg to be read by python -m pstats
+    all         both
+
+A Tracer wraps functions where they are looked up, ie module globals or
+class attributes, so callers need no change; coroutine functions are timed
+until they return, eg the network time of a TTS call.  Times are inclusive:
+a traced function calling another is timed as a whole, and so is the other.
+"""
+
+import atexit, functools, os, sys, threading, time
+
+MODES = ('off', 'summary', 'profile', 'all')
+
+
+class Tracer:
+    """ calls, seconds and counts of instrumented functions, by name
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stats = {}             # name -> [calls, seconds, max seconds, count]
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed, count=None):
+        with self._lock:
+            stat = self.stats.setdefault(name, [0, 0.0, 0.0, None])
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+            if count is not None:
+                stat[3] = (stat[3] or 0) + count
+
+    def wrap(self, name, function, counter=None):
+        """ function timed, and its result counted by counter(result), if given
+        """
+        import inspect
+        record = self.record
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def traced(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = await function(*args, **kwargs)
+                except BaseException:
+                    record(name, time.perf_counter() - start)
+                    raise
+                record(name, time.perf_counter() - start, counter(result) if counter else None)
+                return result
+        else:
+            @functools.wraps(function)
+            def traced(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    result = function(*args, **kwargs)
+                except BaseException:
+                    record(name, time.perf_counter() - start)
+                    raise
+                record(name, time.perf_counter() - start, counter(result) if counter else None)
+                return result
+        traced.__traced__ = function
+        return traced
+
+    def instrument(self, namespace, functions, prefix=''):
+        """ wrap functions, ie {name: counter or None}, of namespace, a module or class
+        """
+        for name, counter in functions.items():
+            function = getattr(namespace, name)
+            if not hasattr(function, '__traced__'):
+                setattr(namespace, name, self.wrap(prefix + name, function, counter))
+
+    def report(self):
+        lines = [f"--- Trace: {time.perf_counter() - self.started:.2f} s ---",
+                 f"    {'function':<28} {'calls':>7} {'total s':>9} {'mean ms':>9} {'max ms':>9} {'count':>9}"]
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        for name, (calls, seconds, longest, count) in stats:
+            lines.append(f"    {name:<28} {calls:>7} {seconds:>9.3f} {seconds / calls * 1e3:>9.3f} "
+                         f"{longest * 1e3:>9.3f} {'' if count is None else count:>9}")
+        return '\n'.join(lines)
+
+
+def start(mode, profileFile='pybible.prof'):
+    """ start tracing in mode, see MODES
+
+    return Tracer to instrument functions with, or None if mode is off
+        (or for profile only)
+    """
+    mode = (mode or 'off').strip().lower()
+    if mode in ('', '0', 'no', 'false'):
+        mode = 'off'
+    elif mode in ('1', 'yes', 'true', 'on'):
+        mode = 'summary'
+    if mode not in MODES:
+        print(f"\n!!! Unknown trace mode {mode!r}, one of {', '.join(MODES)} !!!\n", file=sys.stderr)
+        return None
+    if mode in ('profile', 'all'):
+        import cProfile
+        profileFile = os.path.abspath(profileFile)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(profileFile)
+            print(f"--- Profile written to {profileFile} ---", file=sys.stderr)
+        atexit.register(dump)
+    if mode in ('summary', 'all'):
+        tracer = Tracer()
+        atexit.register(lambda: print(tracer.report(), file=sys.stderr))
+        return tracer
+    return None
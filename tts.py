@@ -0,0 +1,443 @@
+"""
+Text-to-speech engines, and a scheduler that synthesizes many audio files
+concurrently.
+
+An engine has a coroutine, synthesize(text, fileName), which writes the
+audio of text to fileName, and an async generator, stream(text), which
+yields the audio as it arrives:
+    1. EdgeTTS -- edge-tts/MS, async already
+    2. GTTS -- gtts/google, run in a worker thread
+    3. FakeTTS -- local, writes silent mp3 frames, for tests and benchmarks
+
+synthesize_all() runs a list of (text, fileName) jobs with bounded
+concurrency, retries failed jobs with backoff, and returns a summary of
+generated, cached (skipped) and failed files.  With an AudioCache (see
+audiocache.py), a file counts as cached only if it is intact audio of the
+same text, language, voice and engine.
+
+assemble_all() builds long audio, eg a chapter, from segments, eg its
+title and verses: each segment is synthesized (or found in the cache) on
+its own, and the audio is joined frame by frame.  Correcting a verse then
+costs one short synthesis, not the whole chapter again.
+
+stream_play() does the same for one chapter while it is played: audio of
+each segment is piped to the player as it arrives, and saved to the cache
+at the same time, so the first verse is heard before the last is spoken.
+
+A Prefetcher assembles upcoming chapters in a background thread, eg while
+the current one is played.
+"""
+
+import asyncio
+import os, shlex, subprocess, threading
+from pathlib import Path
+
+from audiocache import concat_mp3, mp3_payload
+
+
+class EdgeTTS:
+    """ edge-tts/MS
+    """
+    name = 'edge-tts'
+    voices = {'zh-TW': 'zh-TW-HsiaoYuNeural', 'en': 'en-US-AriaNeural'}
+
+    def __init__(self, language='zh-TW'):
+        import edge_tts
+        self._edge_tts = edge_tts
+        self.language = language
+        self.voice = self.voice_for(language)
+
+    @classmethod
+    def voice_for(cls, language):
+        return cls.voices.get(language, cls.voices['en'])
+
+    async def synthesize(self, text, fileName):
+        communicate = self._edge_tts.Communicate(text, self.voice)
+        await communicate.save(fileName)
+
+    async def stream(self, text):
+        async for chunk in self._edge_tts.Communicate(text, self.voice).stream():
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+
+class GTTS:
+    """ gtts/google, which is blocking, so it runs in a worker thread
+    """
+    name = 'gtts'
+
+    def __init__(self, language='zh-TW'):
+        from gtts import gTTS
+        self._gTTS = gTTS
+        self.language = language
+        self.voice = self.voice_for(language)
+
+    @classmethod
+    def voice_for(cls, language):
+        return language
+
+    async def synthesize(self, text, fileName):
+        audioObj = self._gTTS(text=text, lang=self.language, lang_check=False)
+        await asyncio.to_thread(audioObj.save, fileName)
+
+    async def stream(self, text):
+        chunks = self._gTTS(text=text, lang=self.language, lang_check=False).stream()
+        while (data := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield data
+
+
+class FakeTTS:
+    """ local stand-in of a TTS engine: silent mp3 frames, one per few characters
+
+    delay simulates the network time of each call, and the first failures
+        calls fail, to exercise retries
+    """
+    name = 'fake'
+    #   MPEG-1 layer III, 128 kbit/s, 44.1 kHz, no padding: 417 bytes per frame
+    FRAME = b'\xff\xfb\x90\x64' + bytes(413)
+
+    def __init__(self, language='zh-TW', delay=0.0, failures=0):
+        self.language = language
+        self.voice = self.voice_for(language)
+        self.delay = delay
+        self.failures = failures
+        self.calls = 0
+
+    @classmethod
+    def voice_for(cls, language):
+        return f"fake-{language}"
+
+    async def synthesize(self, text, fileName):
+        with open(fileName, 'wb') as f:
+            async for data in self.stream(text):
+                f.write(data)
+
+    async def stream(self, text):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("fake TTS failure")
+        frames = len(text) // 4 + 1
+        for i in range(0, frames, 16):
+            yield self.FRAME * min(16, frames - i)
+
+
+ENGINES = {'edge-tts': EdgeTTS, 'gtts': GTTS, 'fake': FakeTTS}
+
+def audio_key(cache, text, language='zh-TW', engine='edge-tts'):
+    """ cache key of the audio of text, by engine name, without loading the engine
+    """
+    engineClass = ENGINES.get(engine, EdgeTTS)
+    return cache.key(text, language, engineClass.voice_for(language), engineClass.name)
+
+def make_engine(engine='edge-tts', language='zh-TW'):
+    """ TTS engine by name, or None if it is not installed
+    """
+    try:
+        return ENGINES.get(engine, EdgeTTS)(language)
+    except ImportError:
+        print(f"\n !!! No TTS engine installed !!!")
+        print(f"     !!!! Please install {engine} !!!!\n")
+        return None
+
+
+#   arguments of players to play mp3 from stdin
+PLAYER_STDIN = {
+    'vlc': ['--play-and-exit', '-'],
+    'cvlc': ['--play-and-exit', '-'],
+    'play': ['-q', '-t', 'mp3', '-'],
+    'mpv': ['--really-quiet', '-'],
+    'ffplay': ['-nodisp', '-autoexit', '-loglevel', 'quiet', '-'],
+}
+
+def player_command(player, fileName=None):
+    """ argument list to play fileName, or mp3 from stdin if no fileName
+
+    player may carry its own options, eg 'vlc --intf dummy'
+    """
+    command = shlex.split(player)
+    if fileName is None:
+        return command + PLAYER_STDIN.get(os.path.basename(command[0]), ['-'])
+    return command + [fileName]
+
+def start_player(player, fileName=None):
+    """ start player as a subprocess (no shell), in the background
+    """
+    return subprocess.Popen(player_command(player, fileName),
+                            stdin=subprocess.PIPE if fileName is None else subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+class PlayerSink:
+    """ mp3 written to the stdin of a player
+
+    if the player is closed, the rest is dropped, but audio is still saved
+    """
+    def __init__(self, player):
+        self.proc = start_player(player)
+        self.closed = False
+
+    def _write(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    async def __call__(self, data):
+        if self.closed:
+            return
+        try:
+            await asyncio.to_thread(self._write, data)
+        except OSError:             # eg BrokenPipeError
+            self.closed = True
+
+    def close(self):
+        """ end of audio, the player finishes on its own
+        """
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+
+class SynthesisSummary:
+    """ files generated, skipped because cached, and failed by synthesize_all()
+    """
+    def __init__(self):
+        self.generated = []
+        self.cached = []
+        self.failed = []            # (fileName, error)
+        self.segments = None        # summary of segments, by assemble_all()
+
+    def __str__(self):
+        lines = [f"--- Audio: {len(self.generated)} generated, {len(self.cached)} cached, {len(self.failed)} failed ---"]
+        if self.segments is not None:
+            segments = self.segments
+            lines.append(f"    segments: {len(segments.generated)} generated, {len(segments.cached)} cached, {len(segments.failed)} failed")
+        for fileName, error in self.failed:
+            lines.append(f"    FAILED {fileName}: {error}")
+        return '\n'.join(lines)
+
+
+async def synthesize(text, fileName, engine, retries=3, backoff=1.0):
+    """ synthesize one file, retrying with exponential backoff
+
+    audio is written aside and renamed, so a failed or killed run never
+        leaves a partial file behind
+    """
+    tmpName = f"{fileName}.part"
+    for attempt in range(retries+1):
+        try:
+            await engine.synthesize(text, tmpName)
+            os.replace(tmpName, fileName)
+            return
+        except asyncio.CancelledError:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        except Exception:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2**attempt)
+
+async def synthesize_all(jobs, engine, max_concurrency=4, retries=3, backoff=1.0, cache=None):
+    """ synthesize (text, fileName) jobs, at most max_concurrency at a time
+
+    files already there are skipped, or with cache, files that are intact
+        audio of the same text by the same engine and voice
+    """
+    summary = SynthesisSummary()
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(text, fileName):
+        if cache is None:
+            key = None
+            cached = Path(fileName).exists()
+        else:
+            key = cache.key(text, engine.language, engine.voice, engine.name)
+            cached = cache.lookup(fileName, key)
+        if cached:
+            summary.cached.append(fileName)
+            return
+        async with semaphore:
+            try:
+                await synthesize(text, fileName, engine, retries, backoff)
+                if cache is not None:
+                    cache.record(fileName, key)
+                summary.generated.append(fileName)
+            except Exception as e:
+                summary.failed.append((fileName, e))
+
+    await asyncio.gather(*(run(text, fileName) for text, fileName in jobs))
+    if cache is not None:
+        cache.save()
+    return summary
+
+def run_synthesis(jobs, engine, max_concurrency=4, retries=3, backoff=1.0, cache=None):
+    """ synthesize_all() for callers that are not async
+    """
+    return asyncio.run(synthesize_all(jobs, engine, max_concurrency, retries, backoff, cache))
+
+async def assemble_all(jobs, engine, cache, max_concurrency=4, retries=3, backoff=1.0):
+    """ build (segments, fileName) jobs, each by joining the audio of its segments
+
+    segment audio is content-addressed in cache, see AudioCache.verse_path(),
+        and only segments not there are synthesized
+    """
+    summary = SynthesisSummary()
+    todo = []                       # (fileName, key, segment files)
+    segmentJobs = {}                # segment file -> text
+    for segments, fileName in jobs:
+        segments = [text for text in segments if text.strip()]
+        key = cache.key('\n'.join(segments), engine.language, engine.voice, engine.name)
+        parts = [cache.verse_path(cache.key(text, engine.language, engine.voice, engine.name), engine.language)
+                 for text in segments]
+        if cache.lookup(fileName, key):
+            cache.link(fileName, parts)
+            summary.cached.append(fileName)
+            continue
+        segmentJobs.update(zip(parts, segments))
+        todo.append((fileName, key, parts))
+    #   segments are kept until they are joined, whatever another thread evicts
+    with cache.pinned(segmentJobs):
+        summary.segments = await synthesize_all([(text, part) for part, text in segmentJobs.items()],
+                                                engine, max_concurrency, retries, backoff, cache)
+        failedParts = {part for part, _ in summary.segments.failed}
+        for fileName, key, parts in todo:
+            missing = sum(part in failedParts for part in parts)
+            if missing:
+                summary.failed.append((fileName, f"{missing} segment/s failed"))
+                continue
+            try:
+                concat_mp3(parts, fileName)
+                cache.record(fileName, key, parts)
+                summary.generated.append(fileName)
+            except (OSError, ValueError) as e:
+                summary.failed.append((fileName, e))
+    cache.evict()
+    cache.save()
+    return summary
+
+def run_assembly(jobs, engine, cache, max_concurrency=4, retries=3, backoff=1.0):
+    """ assemble_all() for callers that are not async
+    """
+    return asyncio.run(assemble_all(jobs, engine, cache, max_concurrency, retries, backoff))
+
+async def stream_all(segments, fileName, engine, cache, sink):
+    """ speak segments in order into sink, an async callable taking mp3 data,
+            as the audio arrives, and join their audio into fileName
+
+    audio of each segment is saved to cache while it is streamed, segments
+        in cache already are read from there
+    """
+    summary = SynthesisSummary()
+    summary.segments = SynthesisSummary()
+    segments = [text for text in segments if text.strip()]
+    key = cache.key('\n'.join(segments), engine.language, engine.voice, engine.name)
+    partKeys = [cache.key(text, engine.language, engine.voice, engine.name) for text in segments]
+    parts = [cache.verse_path(partKey, engine.language) for partKey in partKeys]
+    #   segments are kept until they are joined, whatever another thread evicts
+    with cache.pinned(parts):
+        for text, partKey, part in zip(segments, partKeys, parts):
+            if cache.lookup(part, partKey):
+                with open(part, 'rb') as f:
+                    await sink(mp3_payload(f.read()))
+                summary.segments.cached.append(part)
+                continue
+            tmpName = f"{part}.part"
+            try:
+                with open(tmpName, 'wb') as f:
+                    async for data in engine.stream(text):
+                        f.write(data)
+                        await sink(data)
+                os.replace(tmpName, part)
+                cache.record(part, partKey)
+                summary.segments.generated.append(part)
+            except Exception as e:
+                if os.path.exists(tmpName):
+                    os.remove(tmpName)
+                summary.segments.failed.append((part, e))
+        if summary.segments.failed:
+            summary.failed.append((fileName, f"{len(summary.segments.failed)} segment/s failed"))
+        else:
+            concat_mp3(parts, fileName)
+            cache.record(fileName, key, parts)
+            summary.generated.append(fileName)
+    cache.evict()
+    cache.save()
+    return summary
+
+def stream_play(segments, fileName, engine, cache, player):
+    """ play segments with player, streaming the audio not in cache yet
+
+    if fileName is the audio of segments already, it is simply played
+    """
+    segmentsKey = cache.key('\n'.join(text for text in segments if text.strip()),
+                            engine.language, engine.voice, engine.name)
+    if cache.lookup(fileName, segmentsKey):
+        start_player(player, fileName)
+        summary = SynthesisSummary()
+        summary.cached.append(fileName)
+        return summary
+    sink = PlayerSink(player)
+    try:
+        return asyncio.run(stream_all(segments, fileName, engine, cache, sink))
+    finally:
+        sink.close()
+
+
+class Prefetcher:
+    """ assemble audio (see assemble_all) in a background thread, one job at a time
+
+    eg the next chapters, while the current chapter is played
+    """
+    def __init__(self, engine, cache, max_concurrency=4, retries=3):
+        self.engine = engine
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self._futures = {}          # fileName -> future of its assembly
+        self._lock = asyncio.Lock() # one job at a time, in the order they were asked for
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    async def _assemble(self, job):
+        async with self._lock:
+            return await assemble_all([job], self.engine, self.cache, self.max_concurrency, self.retries)
+
+    def prefetch(self, jobs):
+        """ assemble (segments, fileName) jobs in the background, if not asked for already
+        """
+        for segments, fileName in jobs:
+            if fileName not in self._futures:
+                self._futures[fileName] = asyncio.run_coroutine_threadsafe(
+                    self._assemble((segments, fileName)), self._loop)
+
+    def wait(self, fileName):
+        """ wait for fileName, if it is being prefetched, so it is not synthesized twice
+        """
+        future = self._futures.pop(fileName, None)
+        if future is not None:
+            try:
+                return future.result()
+            except (Exception, asyncio.CancelledError):
+                return None
+
+    async def _shutdown(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        """ cancel what is left, and stop the background thread
+        """
+        self._futures.clear()
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
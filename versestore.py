@@ -0,0 +1,468 @@
+"""
+Compact, array-backed store of a bible version.
+
+All verse text of a version lives in one contiguous UTF-8 buffer, with an
+integer offset array marking where each verse starts.  Verses are numbered
+0, 1, 2, ... (verse id) in canonical order; two more arrays give the first
+chapter of each book and the first verse id of each chapter.
+
+    books           names of books, in canonical order
+    bookStart       bookStart[b] is the index of the first chapter of book b
+    chapterStart    chapterStart[c] is the first verse id of chapter index c
+    verseNos        verse number of each verse id
+    offsets         text of verse id i is buffer[offsets[i]:offsets[i+1]]
+
+A VerseStore is still read as the nested dict it replaces, ie
+    store[book][chapter][verse]
+and a whole chapter or book is a single slice of the buffer.
+
+The same arrays are saved as a binary corpus file (see write_corpus), which
+load_corpus maps into memory: nothing is decoded until a verse is read.
+
+    header          magic, format version, #books, #chapters, #verses, size of names
+    names           book names, utf-8, separated by newline, padded to 4 bytes
+    bookStart       uint32 x (#books + 1)
+    chapterStart    uint32 x (#chapters + 1)
+    offsets         uint32 x (#verses + 1)
+    verseNos        uint16 x #verses, padded to 4 bytes
+    text            utf-8 text of all verses
+
+All integers are little-endian.  To convert a pickle file:
+    python versestore.py cbible.pkl cbible.pbc
+or just load it: a pickle file is converted on first load to a binary
+corpus file beside it, eg cbible.pkl to cbible.pbc, with the size and mtime
+of the pickle file in cbible.pbc.stamp, and loaded instead as long as the
+pickle file is still that size and mtime, ie until it is written again, eg
+by Journal.compact, or replaced, even by an older file.
+
+Corrections of verses are appended to a Journal, one json line each, and
+replayed on top of the text file when it is loaded; Journal.compact folds
+them into the text file itself.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+import json, mmap, os, pickle, struct, sys
+
+MAGIC = b'PYBIBLE\0'
+VERSION = 1
+_HEADER = struct.Struct('<8sIIIII')
+
+
+class VerseStore(Mapping):
+    """ bible[book][chapter][verse] -> text, backed by one text buffer
+    """
+
+    def __init__(self, books, bookStart, chapterStart, verseNos, offsets, buffer):
+        self.books = books
+        self.bookStart = bookStart
+        self.chapterStart = chapterStart
+        self.verseNos = verseNos
+        self.offsets = offsets
+        self.buffer = buffer
+        self._bookIndex = {book: b for b, book in enumerate(books)}
+        self._edits = {}            # verse id -> corrected text
+
+    @classmethod
+    def from_dict(cls, bible_dc):
+        """ build from the nested dict, ie bible_dc[book][chapter][verse]
+        """
+        books = list(bible_dc.keys())
+        bookStart = array('I', [0])
+        chapterStart = array('I', [0])
+        verseNos = array('H')
+        offsets = array('I', [0])
+        chunks = []
+        size = 0
+        for book in books:
+            for chapter in range(1, len(bible_dc[book])+1):
+                for verse, text in bible_dc[book][chapter].items():
+                    data = text.encode('utf-8')
+                    chunks.append(data)
+                    size += len(data)
+                    verseNos.append(verse)
+                    offsets.append(size)
+                chapterStart.append(len(verseNos))
+            bookStart.append(len(chapterStart)-1)
+        return cls(books, bookStart, chapterStart, verseNos, offsets, b''.join(chunks))
+
+    @classmethod
+    def from_buffer(cls, buf):
+        """ build on a binary corpus, eg mmap of a file written by write_corpus()
+        """
+        magic, version, nBooks, nChapters, nVerses, namesSize = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a bible corpus file.")
+        if version != VERSION:
+            raise ValueError(f"Unsupported bible corpus version {version}.")
+        view = memoryview(buf)
+        pos = _HEADER.size
+        books = str(view[pos:pos+namesSize], 'utf-8').split('\n')
+        pos += _pad4(namesSize)
+        bookStart, pos = _cast(view, pos, 'I', nBooks+1)
+        chapterStart, pos = _cast(view, pos, 'I', nChapters+1)
+        offsets, pos = _cast(view, pos, 'I', nVerses+1)
+        verseNos, _ = _cast(view, pos, 'H', nVerses)
+        pos += _pad4(2*nVerses)
+        return cls(books, bookStart, chapterStart, verseNos, offsets, view[pos:])
+
+    def to_dict(self):
+        """ the nested OrderedDict this store replaces, eg for pickle.dump
+        """
+        bible_dc = OrderedDict()
+        for book in self.books:
+            bible_dc[book] = {}
+            for chapter, verses in self[book].items():
+                bible_dc[book][chapter] = dict(verses.items())
+        return bible_dc
+
+    #
+    #   Mapping of book -> chapters
+    #
+    def __getitem__(self, book):
+        return _BookView(self, self._bookIndex[book])
+
+    def __len__(self):
+        return len(self.books)
+
+    def __iter__(self):
+        return iter(self.books)
+
+    def __contains__(self, book):
+        return book in self._bookIndex
+
+    def __reduce__(self):
+        return (VerseStore.from_dict, (self.to_dict(),))
+
+    #
+    #   flat access by verse id
+    #
+    def count(self):
+        """ total no. of verses
+        """
+        return len(self.verseNos)
+
+    def text(self, i):
+        """ text of verse id i
+        """
+        if self._edits and i in self._edits:
+            return self._edits[i]
+        return str(self.buffer[self.offsets[i]:self.offsets[i+1]], 'utf-8')
+
+    def texts(self, first, last):
+        """ text of verse ids first .. last-1, read as one slice of the buffer
+        """
+        base = self.offsets[first]
+        data = bytes(self.buffer[base:self.offsets[last]])
+        offsets = self.offsets
+        result = [str(data[offsets[i]-base:offsets[i+1]-base], 'utf-8') for i in range(first, last)]
+        if self._edits:
+            for i, text in self._edits.items():
+                if first <= i < last:
+                    result[i-first] = text
+        return result
+
+    def book_range(self, book):
+        """ (first, last) verse ids of a book, last excluded
+        """
+        b = self._bookIndex[book]
+        return self.chapterStart[self.bookStart[b]], self.chapterStart[self.bookStart[b+1]]
+
+    def chapter_range(self, book, chapter):
+        """ (first, last) verse ids of a chapter, last excluded
+        """
+        c = self._chapterIndex(self._bookIndex[book], chapter)
+        return self.chapterStart[c], self.chapterStart[c+1]
+
+    def index(self, book, chapter, verse):
+        """ verse id of book chapter:verse
+        """
+        first, last = self.chapter_range(book, chapter)
+        return self._find(first, last, verse)
+
+    def ref(self, i):
+        """ (book, chapter, verse) of verse id i
+        """
+        c = bisect_right(self.chapterStart, i) - 1
+        b = bisect_right(self.bookStart, c) - 1
+        return self.books[b], c - self.bookStart[b] + 1, self.verseNos[i]
+
+    def refs(self, first=0, last=None):
+        """ (book, chapter, verse) of verse ids first .. last-1, all if not given
+        """
+        last = self.count() if last is None else last
+        result = []
+        if first >= last:
+            return result
+        verseNos = self.verseNos
+        c = bisect_right(self.chapterStart, first) - 1
+        b = bisect_right(self.bookStart, c) - 1
+        for b in range(b, len(self.books)):
+            book = self.books[b]
+            for c in range(max(c, self.bookStart[b]), self.bookStart[b+1]):
+                chapter = c - self.bookStart[b] + 1
+                result.extend((book, chapter, verseNos[i])
+                    for i in range(max(first, self.chapterStart[c]), min(last, self.chapterStart[c+1])))
+                if self.chapterStart[c+1] >= last:
+                    return result
+        return result
+
+    def _chapterIndex(self, b, chapter):
+        if not isinstance(chapter, int) or chapter < 1 or chapter > self.bookStart[b+1] - self.bookStart[b]:
+            raise KeyError(chapter)
+        return self.bookStart[b] + chapter - 1
+
+    def _find(self, first, last, verse):
+        #   verses are mostly numbered 1..n, try that first
+        i = first + verse - 1 if isinstance(verse, int) else -1
+        if first <= i < last and self.verseNos[i] == verse:
+            return i
+        i = bisect_left(self.verseNos, verse, first, last) if isinstance(verse, int) else last
+        if i < last and self.verseNos[i] == verse:
+            return i
+        raise KeyError(verse)
+
+
+class _BookView(Mapping):
+    """ chapter -> verses of a book in a VerseStore
+    """
+    __slots__ = ('_store', '_b')
+
+    def __init__(self, store, b):
+        self._store = store
+        self._b = b
+
+    def __getitem__(self, chapter):
+        c = self._store._chapterIndex(self._b, chapter)
+        return _ChapterView(self._store, self._store.chapterStart[c], self._store.chapterStart[c+1])
+
+    def __len__(self):
+        return self._store.bookStart[self._b+1] - self._store.bookStart[self._b]
+
+    def __iter__(self):
+        return iter(range(1, len(self)+1))
+
+
+class _ChapterView(Mapping):
+    """ verse -> text of a chapter in a VerseStore
+    """
+    __slots__ = ('_store', '_first', '_last')
+
+    def __init__(self, store, first, last):
+        self._store = store
+        self._first = first
+        self._last = last
+
+    def __getitem__(self, verse):
+        return self._store.text(self._store._find(self._first, self._last, verse))
+
+    def __setitem__(self, verse, text):
+        self._store._edits[self._store._find(self._first, self._last, verse)] = text
+
+    def __len__(self):
+        return self._last - self._first
+
+    def __iter__(self):
+        return iter(self._store.verseNos[self._first:self._last])
+
+    def values(self):
+        return self._store.texts(self._first, self._last)
+
+    def items(self):
+        return list(zip(self._store.verseNos[self._first:self._last], self.values()))
+
+
+def _pad4(size):
+    return (size + 3) & ~3
+
+def _cast(view, pos, typecode, count):
+    """ array of count typecode items at view[pos:], without copy if we can
+    """
+    size = array(typecode).itemsize * count
+    if sys.byteorder == 'little':
+        return view[pos:pos+size].cast(typecode), pos + size
+    items = array(typecode, view[pos:pos+size].tobytes())
+    items.byteswap()
+    return items, pos + size
+
+def _le(typecode, items):
+    items = array(typecode, items)
+    if sys.byteorder != 'little':
+        items.byteswap()
+    return items.tobytes()
+
+def write_corpus(bible_dc, fileName):
+    """ write a bible version, ie nested dict or VerseStore, to a binary corpus file
+
+    the file is written aside and then renamed, so readers never see a partial file
+    """
+    store = bible_dc if isinstance(bible_dc, VerseStore) else VerseStore.from_dict(bible_dc)
+    if store._edits:        # fold corrections into the text
+        store = VerseStore.from_dict(store.to_dict())
+    names = '\n'.join(store.books).encode('utf-8')
+    tmpName = f"{fileName}.{os.getpid()}.tmp"
+    with open(tmpName, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(store.books), len(store.chapterStart)-1,
+                             store.count(), len(names)))
+        f.write(names.ljust(_pad4(len(names)), b'\0'))
+        f.write(_le('I', store.bookStart))
+        f.write(_le('I', store.chapterStart))
+        f.write(_le('I', store.offsets))
+        verseNos = _le('H', store.verseNos)
+        f.write(verseNos.ljust(_pad4(len(verseNos)), b'\0'))
+        f.write(store.buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpName, fileName)
+
+def _map_corpus(fileName):
+    """ VerseStore on a memory mapped binary corpus file, None if fileName is not one
+    """
+    with open(fileName, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return VerseStore.from_buffer(buf)
+
+def corpus_name(fileName):
+    """ name of the binary corpus file a pickle file is converted to, see load_corpus()
+    """
+    return os.path.splitext(fileName)[0] + '.pbc'
+
+def _stamp(fileName):
+    """ [size, mtime] of fileName
+    """
+    stat = os.stat(fileName)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def load_corpus(fileName):
+    """ load a bible version as VerseStore, from either
+            1. binary corpus file -- memory mapped, or
+            2. pickle file of nested dict -- by its binary corpus file, eg
+               bible.pbc for bible.pkl, written on first load, see above
+    """
+    store = _map_corpus(fileName)
+    if store is not None:
+        return store
+    binaryName = corpus_name(fileName)
+    stampName = f"{binaryName}.stamp"
+    if binaryName != fileName:
+        try:
+            with open(stampName, encoding='utf-8') as f:
+                converted = json.load(f) == _stamp(fileName)
+            if converted:
+                store = _map_corpus(binaryName)
+                if store is not None:
+                    return store
+        except (OSError, ValueError):       # not converted yet
+            pass
+    source = _stamp(fileName)
+    with open(fileName, 'rb') as f:
+        store = VerseStore.from_dict(pickle.load(f, encoding='utf-8'))
+    if binaryName == fileName:
+        return store
+    try:
+        write_corpus(store, binaryName)
+        tmpName = f"{stampName}.{os.getpid()}.tmp"
+        with open(tmpName, 'w', encoding='utf-8') as f:
+            json.dump(source, f)
+        os.replace(tmpName, stampName)
+    except OSError:             # eg read only directory, load the pickle file each time
+        return store
+    return _map_corpus(binaryName)
+
+def save_corpus(bible_dc, fileName):
+    """ save a bible version in the format fileName already is, or
+            binary corpus for a new .pbc file, pickle otherwise
+    """
+    binary = fileName.endswith('.pbc')
+    if os.path.exists(fileName):
+        with open(fileName, 'rb') as f:
+            binary = f.read(len(MAGIC)) == MAGIC
+    if binary:
+        write_corpus(bible_dc, fileName)
+        return
+    if isinstance(bible_dc, VerseStore):
+        bible_dc = bible_dc.to_dict()
+    tmpName = f"{fileName}.tmp"
+    with open(tmpName, 'wb') as f:
+        pickle.dump(bible_dc, f)
+    os.replace(tmpName, fileName)
+
+class Journal:
+    """ append-only log of verse corrections, keyed by language/book/chapter/verse
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+    def append(self, language, book, chapter, verse, text):
+        """ log one correction, on disk when this returns
+        """
+        record = {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'language': language, 'book': book, 'chapter': chapter, 'verse': verse,
+            'text': text,
+        }
+        with open(self.fileName, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def records(self, language=None):
+        """ logged corrections, of language only if given, oldest first
+        """
+        if not os.path.exists(self.fileName):
+            return []
+        result = []
+        with open(self.fileName, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:      # eg half written line of a crashed run
+                    continue
+                if language is None or record['language'] == language:
+                    result.append(record)
+        return result
+
+    def replay(self, store, language):
+        """ apply logged corrections of language to store, return # of corrections
+        """
+        records = self.records(language)
+        for r in records:
+            try:
+                store[r['book']][r['chapter']][r['verse']] = r['text']
+            except KeyError:
+                print(f"  !!! No verse {r['book']} {r['chapter']}:{r['verse']} to correct !!!", file=sys.stderr)
+        return len(records)
+
+    def compact(self, language, fileName):
+        """ fold logged corrections of language into text file fileName, and
+                drop them from the log
+
+        both files are written aside and renamed, a crash in between only
+            leaves corrections that are replayed again
+        """
+        records = self.records(language)
+        if not records:
+            return 0
+        store = load_corpus(fileName)
+        self.replay(store, language)
+        save_corpus(store, fileName)
+        others = [r for r in self.records() if r['language'] != language]
+        tmpName = f"{self.fileName}.tmp"
+        with open(tmpName, 'w', encoding='utf-8') as f:
+            for r in others:
+                f.write(json.dumps(r, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpName, self.fileName)
+        return len(records)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f"usage: python {sys.argv[0]} bible.pkl bible.pbc")
+        sys.exit(1)
+    write_corpus(load_corpus(sys.argv[1]), sys.argv[2])